@@ -0,0 +1,289 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import timeit
+import uuid
+from kazurator import ReadWriteLock
+from kazurator.internals import LockDriver
+from kazurator.mutex import DEFAULT_LOCK_NAME
+from kazurator.read_write_lock import (
+    _LockDriver,
+    _read_is_acquirable_in,
+    READ_LOCK_NAME,
+    WRITE_LOCK_NAME
+)
+from kazurator.testing import FakeClient
+
+# Microbenchmarks for the pure python decision paths that run against the full
+# child list every time a waiter wakes up.
+#
+#   python -m benchmarks.drivers --save before.json
+#   python -m benchmarks.drivers --compare before.json
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+DEFAULT_THRESHOLD = 1.25
+PATH = "/benchmarks/lock"
+
+
+def _node(name, sequence):
+    return "_c_{}-{}{:010d}".format(uuid.uuid4(), name, sequence)
+
+
+def mutex_children(size):
+    return [_node(DEFAULT_LOCK_NAME, i) for i in range(size)]
+
+
+def rw_children(size, write_ratio=0.1, seed=42):
+    rand = random.Random(seed)
+    children = []
+
+    for i in range(size):
+        name = READ_LOCK_NAME
+        if rand.random() < write_ratio:
+            name = WRITE_LOCK_NAME
+
+        children.append(_node(name, i))
+
+    return children
+
+
+def _shuffled(children):
+    children = list(children)
+    random.Random(7).shuffle(children)
+    return children
+
+
+def _last_reader(children):
+    for child in reversed(children):
+        if READ_LOCK_NAME in child:
+            return child
+
+    return children[-1]
+
+
+def bench_lock_driver_sort_key(size):
+    driver = LockDriver()
+    children = _shuffled(mutex_children(size))
+
+    def run():
+        sorted(children, key=lambda c: driver.sort_key(c, DEFAULT_LOCK_NAME))
+
+    return run
+
+
+def bench_lock_driver_is_acquirable(size):
+    driver = LockDriver()
+    children = mutex_children(size)
+    name = children[-1]
+
+    def run():
+        driver.is_acquirable(children, name, 1)
+
+    return run
+
+
+def bench_lock_driver_is_acquirable_in(size):
+    driver = LockDriver()
+    children = mutex_children(size)
+    index = driver.create_index(DEFAULT_LOCK_NAME, children)
+    name = children[-1]
+
+    def run():
+        driver.is_acquirable_in(index, name, 1)
+
+    return run
+
+
+def bench_participant_index_build(size):
+    driver = _LockDriver()
+    children = _shuffled(rw_children(size))
+
+    def run():
+        driver.create_index(READ_LOCK_NAME, children)
+
+    return run
+
+
+def bench_rw_driver_sort_key(size):
+    driver = _LockDriver()
+    children = _shuffled(rw_children(size))
+
+    def run():
+        sorted(children, key=lambda c: driver.sort_key(c, READ_LOCK_NAME))
+
+    return run
+
+
+def bench_read_predicate_readers_only(size):
+    lock = ReadWriteLock(FakeClient(), PATH)
+    children = rw_children(size, write_ratio=0)
+    name = _last_reader(children)
+
+    def run():
+        lock._read_is_acquirable_predicate(children, name)
+
+    return run
+
+
+def bench_read_predicate_mixed(size):
+    lock = ReadWriteLock(FakeClient(), PATH)
+    children = rw_children(size)
+    name = _last_reader(children)
+
+    def run():
+        lock._read_is_acquirable_predicate(children, name)
+
+    return run
+
+
+def bench_read_index_readers_only(size):
+    children = rw_children(size, write_ratio=0)
+    index = _LockDriver().create_index(READ_LOCK_NAME, children)
+    name = _last_reader(children)
+
+    def run():
+        _read_is_acquirable_in(index, name)
+
+    return run
+
+
+def bench_read_index_mixed(size):
+    children = rw_children(size)
+    index = _LockDriver().create_index(READ_LOCK_NAME, children)
+    name = _last_reader(children)
+
+    def run():
+        _read_is_acquirable_in(index, name)
+
+    return run
+
+
+def bench_read_index_wakeup_all(size):
+    # a writer at the head of the queue releases and every queued reader
+    # re-checks (the list based predicate is quadratic here)
+    children = rw_children(size, write_ratio=0)
+    index = _LockDriver().create_index(READ_LOCK_NAME, children)
+
+    def run():
+        for child in children:
+            _read_is_acquirable_in(index, child)
+
+    return run
+
+
+BENCHMARKS = (
+    ("lock_driver.sort_key", bench_lock_driver_sort_key),
+    ("lock_driver.is_acquirable", bench_lock_driver_is_acquirable),
+    ("lock_driver.is_acquirable_in", bench_lock_driver_is_acquirable_in),
+    ("participant_index.build", bench_participant_index_build),
+    ("rw_driver.sort_key", bench_rw_driver_sort_key),
+    ("read_predicate.readers_only", bench_read_predicate_readers_only),
+    ("read_predicate.mixed", bench_read_predicate_mixed),
+    ("read_index.readers_only", bench_read_index_readers_only),
+    ("read_index.mixed", bench_read_index_mixed),
+    ("read_index.wakeup_all", bench_read_index_wakeup_all),
+)
+
+
+def measure(fn, repeat=5, budget=0.2):
+    # pick a loop count that takes roughly `budget` seconds per repetition,
+    # then report the best per-call time
+    number = 1
+    while True:
+        elapsed = timeit.timeit(fn, number=number)
+        if elapsed >= budget / 10 or number >= 1000000:
+            break
+
+        number *= 10
+
+    number = max(1, int(number * (budget / 10) / max(elapsed, 1e-9)))
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+
+def run(sizes=DEFAULT_SIZES, names=None, repeat=5, label=None,
+        out=sys.stdout):
+    results = {}
+
+    for name, factory in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        results[name] = {}
+        for size in sizes:
+            seconds = measure(factory(size), repeat=repeat)
+            results[name][str(size)] = seconds
+            out.write("{:<32} {:>8} {:>14.3f} us\n".format(
+                name,
+                size,
+                seconds * 1e6
+            ))
+
+    return {
+        "meta": {
+            "label": label,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "timestamp": int(time.time())
+        },
+        "results": results
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, out=sys.stdout):
+    regressions = []
+
+    for name, sizes in sorted(current["results"].items()):
+        for size, seconds in sorted(sizes.items(), key=lambda i: int(i[0])):
+            before = baseline["results"].get(name, {}).get(size)
+            if not before:
+                continue
+
+            ratio = seconds / before
+            flag = ""
+            if ratio > threshold:
+                flag = " REGRESSION"
+                regressions.append((name, size, ratio))
+
+            out.write("{:<32} {:>8} {:>8.2f}x{}\n".format(
+                name,
+                size,
+                ratio,
+                flag
+            ))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.drivers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--only", nargs="+", metavar="NAME")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--label", help="e.g. the release being measured")
+    parser.add_argument("--save", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.only, args.repeat, args.label)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        sys.stdout.write("\n")
+        if compare(baseline, results, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
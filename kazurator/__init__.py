@@ -1,2 +1,7 @@
+from .lock_set import LockSet             # noqa[F401]
 from .mutex import Mutex                   # noqa[F401]
 from .read_write_lock import ReadWriteLock # noqa[F401]
+from .reaper import Reaper                 # noqa[F401]
+from .registry import LockRegistry         # noqa[F401]
+from .sharding import ShardedLocks         # noqa[F401]
+from .semaphore import Semaphore           # noqa[F401]
@@ -0,0 +1,384 @@
+import asyncio
+from sys import maxsize
+from threading import ThreadError
+from kazoo.exceptions import ConnectionLoss, LockTimeout, NoNodeError
+from .internals import LockDriver, _protect
+from .mutex import DEFAULT_LOCK_NAME, _LockData
+from .read_write_lock import (
+    READ_LOCK_NAME,
+    WRITE_LOCK_NAME,
+    _LockDriver,
+    _ReadLockDriver,
+    _read_is_acquirable,
+    _read_is_acquirable_in
+)
+from .utils import lazyproperty, make_path
+
+# asyncio flavours of Mutex and ReadWriteLock. They use the same drivers (and
+# therefore the same znode layout) as the blocking versions, so they contend
+# fairly with those and with Curator, but a waiter only costs a pending future
+# instead of a parked thread. Requires python 3.5+.
+#
+#   async with AsyncMutex(client, "/some/path"):
+#       ...
+
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except AttributeError:  # python < 3.7
+        return asyncio.Task.current_task()
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:  # python < 3.7
+        return asyncio.get_event_loop()
+
+
+def _wrap(async_result, loop):
+    future = loop.create_future()
+
+    def transfer(result):
+        if future.cancelled():
+            return
+
+        if result.successful():
+            future.set_result(result.value)
+        else:
+            future.set_exception(result.exception)
+
+    def callback(result):
+        loop.call_soon_threadsafe(transfer, result)
+
+    async_result.rawlink(callback)
+    return future
+
+
+def _delete_when_done(client, future):
+    # for a create nobody is waiting on any more
+    def delete(future):
+        if not future.cancelled() and future.exception() is None:
+            client.delete_async(future.result())
+
+    future.add_done_callback(delete)
+
+
+class _AsyncLock(object):
+    _TIMEOUT_ERR = "Failed to acquire a lock on %s after %s seconds"
+
+    def __init__(self, client, driver, path, name, max_leases):
+        self._base_path = path
+        self._client = client
+        self._driver = driver
+        self._max_leases = max_leases
+        self._name = name
+        self._path = make_path(path, name)
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def driver(self):
+        return self._driver
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def max_leases(self):
+        return self._max_leases
+
+    async def attempt_lock(self, timeout=None):
+        loop = _running_loop()
+
+        # the deadline covers every retry and wakeup, not each one
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while True:
+            path = await self._create(loop)
+
+            try:
+                if await self._acquire(path, timeout, deadline):
+                    return path
+
+                return None
+            except NoNodeError:
+                # our node (or the lock directory) went away, start over
+                if deadline is not None and loop.time() >= deadline:
+                    raise LockTimeout(
+                        self._TIMEOUT_ERR % (self._base_path, timeout)
+                    )
+
+    async def _create(self, loop):
+        protected_path = _protect(self.path)
+        created = self.driver.create_protected_lock_async(
+            self._client,
+            protected_path
+        )
+        future = _wrap(created, loop)
+
+        # shielded, so that if we're cancelled we still find out which node
+        # the create made
+        try:
+            try:
+                return await asyncio.shield(future)
+            except (ConnectionLoss, NoNodeError):
+                # no lock directory yet, or the response was lost: the
+                # blocking version deals with both, off the loop
+                future = loop.run_in_executor(
+                    None,
+                    self.driver.create_protected_lock,
+                    self._client,
+                    protected_path,
+                    created
+                )
+                return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            _delete_when_done(self._client, future)
+            raise
+
+    async def release_lock(self, lock_path):
+        loop = _running_loop()
+
+        try:
+            await _wrap(self._client.delete_async(lock_path), loop)
+        except NoNodeError:
+            pass
+
+    async def get_participant_nodes(self):
+        children = await self.get_sorted_children()
+        return [make_path(self._base_path, child) for child in children]
+
+    async def get_sorted_children(self):
+        index = await self._get_index()
+        return index.nodes()
+
+    async def _get_index(self):
+        loop = _running_loop()
+        children = await _wrap(
+            self._client.get_children_async(self._base_path),
+            loop
+        )
+
+        return self._driver.create_index(self.name, children)
+
+    async def _acquire(self, path, timeout, deadline):
+        loop = _running_loop()
+        name = path[len(self._base_path) + 1:]
+        event = asyncio.Event()
+
+        def wake(*args):
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # loop already closed
+                pass
+
+        try:
+            while self._client.connected:
+                event.clear()
+
+                index = await self._get_index()
+                path_to_watch, acquirable = self._driver.is_acquirable_in(
+                    index,
+                    name,
+                    self.max_leases
+                )
+
+                if acquirable:
+                    return True
+
+                path_to_watch = make_path(self._base_path, path_to_watch)
+                self._client.add_listener(wake)
+
+                try:
+                    exists = await _wrap(
+                        self._client.exists_async(path_to_watch, wake),
+                        loop
+                    )
+
+                    if exists:
+                        remaining = None
+                        if deadline is not None:
+                            remaining = max(deadline - loop.time(), 0)
+
+                        try:
+                            await asyncio.wait_for(event.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            raise LockTimeout(
+                                self._TIMEOUT_ERR % (self._base_path, timeout)
+                            )
+                finally:
+                    self._client.remove_listener(wake)
+        except BaseException:
+            # we may have been cancelled, so don't wait around for this
+            self._client.delete_async(path)
+            raise
+
+        return False
+
+
+class AsyncMutex(object):
+    def __init__(self, client, path, max_leases=1, **kwargs):
+        self._path = path
+        self._task_data = {}
+        self._timeout = kwargs.get("timeout")
+
+        self._lock = _AsyncLock(
+            client,
+            kwargs.get("driver", LockDriver()),
+            path,
+            kwargs.get("name", DEFAULT_LOCK_NAME),
+            max_leases
+        )
+
+    async def __aenter__(self):
+        await self.acquire_async()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.release_async()
+
+    @property
+    def name(self):
+        return self._lock.name
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+
+    @property
+    def is_acquired(self):
+        return len(self._task_data) > 0
+
+    @property
+    def is_owned_by_current_task(self):
+        data = self._task_data.get(_current_task())
+        return bool(data and data.count > 0)
+
+    async def get_participant_nodes(self):
+        return await self._lock.get_participant_nodes()
+
+    async def acquire_async(self):
+        task = _current_task()
+        data = self._task_data.get(task)
+
+        if data:
+            # re-entering
+            data.increment()
+            return True
+
+        path = await self._lock.attempt_lock(self._timeout)
+        if not path:
+            return False
+
+        self._task_data[task] = _LockData(path)
+        return True
+
+    async def release_async(self):
+        task = _current_task()
+        data = self._task_data.get(task)
+        path = self._path
+
+        if not data:
+            raise ThreadError("You do not own the lock: " + path)
+
+        count = data.decrement()
+        if count < 0:
+            raise ThreadError("Lock count has gone negative: " + path)
+
+        if count == 0:
+            try:
+                await self._lock.release_lock(data.path)
+            finally:
+                del self._task_data[task]
+
+
+class _AsyncMutex(AsyncMutex):
+    def __init__(self, client, path, name, max_leases, driver, timeout):
+        super(_AsyncMutex, self).__init__(
+            client,
+            path,
+            max_leases,
+            name=name,
+            driver=driver,
+            timeout=timeout
+        )
+
+    async def get_participant_nodes(self):
+        nodes = await super(_AsyncMutex, self).get_participant_nodes()
+        return [node for node in nodes if self.name in node]
+
+
+class AsyncReadWriteLock(object):
+    def __init__(self, client, path, timeout=None):
+        self._client = client
+        self._path = path
+        self._timeout = timeout
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+        self.read_lock.timeout = value
+        self.write_lock.timeout = value
+
+    @lazyproperty
+    def read_lock(self):
+        def predicate(children, sequence_node_name):
+            if self.write_lock.is_owned_by_current_task:
+                return (None, True)
+
+            return _read_is_acquirable(children, sequence_node_name)
+
+        def index_predicate(index, sequence_node_name):
+            if self.write_lock.is_owned_by_current_task:
+                return (None, True)
+
+            return _read_is_acquirable_in(index, sequence_node_name)
+
+        return _AsyncMutex(
+            self._client,
+            self.path,
+            READ_LOCK_NAME,
+            maxsize,
+            _ReadLockDriver(predicate, index_predicate),
+            self.timeout
+        )
+
+    @lazyproperty
+    def write_lock(self):
+        return _AsyncMutex(
+            self._client,
+            self.path,
+            WRITE_LOCK_NAME,
+            1,
+            _LockDriver(),
+            self.timeout
+        )
+
+    async def get_participant_nodes(self):
+        nodes = await self.read_lock.get_participant_nodes()
+        nodes.extend(await self.write_lock.get_participant_nodes())
+        return nodes
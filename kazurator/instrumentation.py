@@ -0,0 +1,40 @@
+import time
+
+
+class LockObserver(object):
+    # Receives events from a lock. Subclass it and override whatever you want
+    # to record (e.g. push timings to statsd or prometheus), then pass an
+    # instance as `observer` to Mutex or ReadWriteLock. Every method is called
+    # on the thread doing the work, so keep them cheap.
+    #
+    # `path` is the lock node prefix (e.g. /some/path/__READ__) and all times
+    # are in seconds.
+    def acquire_started(self, path):
+        pass
+
+    def acquire_finished(self, path, seconds, acquired):
+        pass
+
+    def woke_up(self, path):
+        pass
+
+    def timed_out(self, path, seconds):
+        pass
+
+    def released(self, path, held_seconds):
+        pass
+
+    def zookeeper_call(self, path, operation, seconds):
+        pass
+
+
+def timed(observer, path, operation, fn, *args, **kwargs):
+    if observer is None:
+        return fn(*args, **kwargs)
+
+    start = time.time()
+
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        observer.zookeeper_call(path, operation, time.time() - start)
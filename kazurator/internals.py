@@ -1,6 +1,30 @@
+import time
 import uuid
-from kazoo.exceptions import LockTimeout, NoNodeError, NotEmptyError
+from collections import deque
+from contextlib import contextmanager
+from kazoo.exceptions import (
+    CancelledError,
+    ConnectionLoss,
+    LockTimeout,
+    NodeExistsError,
+    NoNodeError,
+    NotEmptyError,
+    UnimplementedError,
+    ZookeeperError
+)
+from kazoo.security import OPEN_ACL_UNSAFE
+from kazoo.protocol.states import EventType, KazooState
+from kazoo.retry import ForceRetryError, KazooRetry
+from .instrumentation import timed
+from .participants import ParticipantIndex
 from .utils import make_path, mutex
+from weakref import WeakKeyDictionary
+
+try:
+    from kazoo.protocol.serialization import Create2 as _Create
+except ImportError:  # kazoo < 2.5
+    # the request is the same, the stat that comes back is just ignored
+    from kazoo.protocol.serialization import Create as _Create
 
 
 # SHAMELESS THEFT FROM CURATOR:
@@ -18,18 +42,322 @@ def _protect(path):
     return "/".join(parts)
 
 
+class _CreateContainer(_Create):
+    # kazoo has no api for container nodes (ZooKeeper 3.5+), but the request
+    # is a create2 with its own opcode
+    type = 19
+
+
+CONTAINER_FLAG = 4
+
+# what each client's server turned out to do with container creates
+_container_support = WeakKeyDictionary()
+
+
+def supports_containers(client, path=None):
+    # Until a container create has told us either way, this assumes the
+    # server has them. Pass an existing directory as `path` to ask the
+    # server instead; that costs one request per client, which only gets a
+    # NodeExistsError back on servers that do.
+    supported = _container_support.get(client)
+
+    if supported is None and path is not None:
+        try:
+            ensure_container(client, path)
+        except ZookeeperError:
+            pass  # ask again next time
+
+        supported = _container_support.get(client)
+
+    return supported is not False
+
+
+def ensure_container(client, path):
+    # Creates path (and any missing parents) as container nodes, which the
+    # server deletes once their last child is gone, so lock directories
+    # don't pile up. Servers older than 3.5 get regular nodes instead, and
+    # it's up to whoever empties them to clean up (see Lock.release_lock).
+    #
+    # kazoo can only send the request through its private _call, so clients
+    # without one get regular nodes too.
+    call = getattr(client, "_call", None)
+    if call is None:
+        _container_support[client] = False
+
+    if path == "/" or not supports_containers(client):
+        client.ensure_path(path)
+        return
+
+    async_result = client.handler.async_result()
+    call(
+        _CreateContainer(
+            client.chroot + path,
+            b"",
+            client.default_acl or OPEN_ACL_UNSAFE,
+            CONTAINER_FLAG
+        ),
+        async_result
+    )
+
+    try:
+        async_result.get()
+    except NodeExistsError:
+        pass
+    except NoNodeError:
+        ensure_container(client, path.rsplit("/", 1)[0] or "/")
+        ensure_container(client, path)
+        return
+    except UnimplementedError:
+        _container_support[client] = False
+        client.ensure_path(path)
+        return
+
+    _container_support[client] = True
+
+
+def fetch_children(client, paths, concurrency=100):
+    # Lists many directories with up to `concurrency` get_children requests
+    # in flight at once, instead of a round trip each. Yields (path,
+    # children) in the order given, with None for missing directories.
+    pending = deque()
+
+    for path in paths:
+        pending.append((path, client.get_children_async(path)))
+
+        if len(pending) >= concurrency:
+            yield _fetched(*pending.popleft())
+
+    while pending:
+        yield _fetched(*pending.popleft())
+
+
+def _fetched(path, async_result):
+    try:
+        return (path, async_result.get())
+    except NoNodeError:
+        return (path, None)
+
+
+# How attempt_lock starts over when our node disappears from under us (e.g.
+# the lock directory was removed). Only ForceRetryError is retried, so
+# connection errors still reach the caller unless a policy that includes
+# them is passed in.
+DEFAULT_RETRY = KazooRetry(
+    max_tries=10,
+    delay=0.05,
+    backoff=2,
+    max_jitter=0.4,
+    max_delay=2.0
+)
+DEFAULT_RETRY.retry_exceptions = (ForceRetryError,)
+
+
+class _ChildrenCache(object):
+    # A sorted view of a lock directory that waiters share instead of each
+    # calling get_children (and re-sorting everything) on every wakeup.
+    #
+    # While anyone is waiting, a child watch keeps the view fresh. ZooKeeper
+    # only tells us that *something* changed, so each notification costs one
+    # get_children for the process, but the result is applied to the
+    # participant index as a diff rather than a full sort. Waiters that find
+    # their predecessor gone remove it directly. When nobody is waiting the
+    # watch is left to lapse and the view is rebuilt on next use.
+    def __init__(self, client, path, index_factory, observer=None,
+                 lock_path=None):
+        self._client = client
+        self._generation = 0
+        self._index = index_factory()
+        self._index_factory = index_factory
+        self._lock = client.handler.lock_object()
+        self._lock_path = lock_path
+        self._observer = observer
+        self._path = path
+        self._pzxid = -1
+        self._users = 0
+        self._valid = False
+        self._watched = False
+
+    def open(self):
+        with mutex(self._lock):
+            self._users += 1
+
+    def close(self):
+        with mutex(self._lock):
+            self._users -= 1
+
+    def watch(self):
+        # keep the view fresh even when nobody is waiting, until unwatch
+        with mutex(self._lock):
+            if not self._watched:
+                self._watched = True
+                self._users += 1
+
+    def unwatch(self):
+        with mutex(self._lock):
+            if self._watched:
+                self._watched = False
+                self._users -= 1
+
+    def children(self, require=None):
+        return self.query(lambda index: index.nodes(), require)
+
+    def query(self, fn, require=None):
+        # evaluates fn against the current index (under our lock)
+        with mutex(self._lock):
+            if self._valid and (require is None or require in self._index):
+                return fn(self._index)
+
+        # we either haven't got a watch in place, or the watch hasn't caught
+        # up with a node we know exists (our own)
+        self.refresh()
+
+        with mutex(self._lock):
+            return fn(self._index)
+
+    def discard(self, name):
+        with mutex(self._lock):
+            self._index.discard(name)
+
+    def refresh(self):
+        while True:
+            with mutex(self._lock):
+                generation = self._generation
+
+            children, stat = timed(
+                self._observer,
+                self._lock_path,
+                "get_children",
+                self._client.get_children,
+                self._path,
+                self._watcher,
+                include_data=True
+            )
+
+            if self._apply(children, stat, generation):
+                return
+
+    def refresh_async(self):
+        # sends the listing without waiting for it, see finish_refresh
+        with mutex(self._lock):
+            generation = self._generation
+
+        async_result = self._client.get_children_async(
+            self._path,
+            self._watcher,
+            include_data=True
+        )
+
+        return (async_result, generation)
+
+    def finish_refresh(self, listing):
+        async_result, generation = listing
+        children, stat = timed(
+            self._observer,
+            self._lock_path,
+            "get_children",
+            async_result.get
+        )
+
+        if not self._apply(children, stat, generation):
+            self.refresh()
+
+    def _apply(self, children, stat, generation):
+        # returns False when the view was invalidated after the listing was
+        # sent. Its watch may already have fired (and been dropped), so the
+        # listing can't be trusted to stay fresh and has to be sent again.
+        with mutex(self._lock):
+            if generation != self._generation:
+                return False
+
+            if stat.pzxid < self._pzxid:
+                # a newer listing has already been applied
+                return True
+
+            self._pzxid = stat.pzxid
+            self._index.replace(children)
+
+            if not self._valid:
+                self._valid = True
+                self._client.add_listener(self._listener)
+
+            return True
+
+    def invalidate(self):
+        with mutex(self._lock):
+            self._generation += 1
+            self._pzxid = -1
+            self._valid = False
+            self._client.remove_listener(self._listener)
+
+    def _watcher(self, event):
+        with mutex(self._lock):
+            active = self._users > 0
+
+        if not active:
+            self.invalidate()
+            return
+
+        try:
+            self.refresh()
+        except ZookeeperError:
+            self.invalidate()
+
+    def _listener(self, state):
+        if state != KazooState.CONNECTED:
+            # watches may not survive this, start over next time
+            with mutex(self._lock):
+                self._generation += 1
+                self._pzxid = -1
+                self._valid = False
+
+            return True
+
+
+class _Waiter(object):
+    # one in-flight attempt_lock, so cancel() can find and wake it
+    def __init__(self):
+        self.cancelled = False
+        self.event = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.event is not None:
+            self.event.set()
+
+    def check(self):
+        if self.cancelled:
+            raise CancelledError()
+
+
 class Lock(object):
     _TIMEOUT_ERR = "Failed to acquire a lock on %s after %s seconds"
 
-    def __init__(self, client, driver, path, name, max_leases):
+    def __init__(self, client, driver, path, name, max_leases, retry=None,
+                 observer=None):
         self._base_path = path
         self._client = client
         self._driver = driver
-        self._lock = client.handler.lock_object()
+        self._held = {}
         self._max_leases = max_leases
         self._name = name
+        self._nodes = set()
+        self._observer = observer
+        self._orphans = set()
         self._path = make_path(path, name)
-        self._watch_handle = client.handler.event_object()
+        self._retry = retry
+        self._waiters = set()
+        self._waiters_lock = client.handler.lock_object()
+
+        if retry is None:
+            self._retry = DEFAULT_RETRY.copy()
+
+        self._children = _ChildrenCache(
+            client,
+            path,
+            lambda: driver.create_index(name),
+            observer,
+            self._path
+        )
 
     @property
     def client(self):
@@ -51,26 +379,173 @@ class Lock(object):
     def max_leases(self):
         return self._max_leases
 
-    def attempt_lock(self, timeout=None):
+    @property
+    def retry(self):
+        return self._retry
+
+    @property
+    def observer(self):
+        return self._observer
+
+    def cancel(self):
+        # wakes every attempt_lock in progress, which deletes its node and
+        # raises CancelledError
+        with mutex(self._waiters_lock):
+            waiters = list(self._waiters)
+
+        for waiter in waiters:
+            waiter.cancel()
+
+    def attempt_lock(self, timeout=None, waiter=None):
+        # `waiter` is for callers that wait on something of their own first,
+        # from a waiting() block, so cancel() reaches both waits
+        if waiter is not None:
+            return self._observed_attempt_lock(timeout, waiter)
+
+        with self.waiting() as waiter:
+            return self._observed_attempt_lock(timeout, waiter)
+
+    @contextmanager
+    def waiting(self):
+        # a waiter that cancel() wakes until the block is done. Point its
+        # event at whatever you're waiting on and check() it after waking.
+        waiter = _Waiter()
+
+        with mutex(self._waiters_lock):
+            self._waiters.add(waiter)
+
+        try:
+            yield waiter
+        finally:
+            with mutex(self._waiters_lock):
+                self._waiters.discard(waiter)
+
+    def _observed_attempt_lock(self, timeout, waiter):
+        observer = self._observer
+        if observer is None:
+            return self._attempt_lock(timeout, waiter)
+
         path = None
-        finished = False
-        lock_acquired = False
+        start = time.time()
+        observer.acquire_started(self._path)
 
-        while not finished:
-            finished = True
+        try:
+            path = self._attempt_lock(timeout, waiter)
+        except LockTimeout:
+            observer.timed_out(self._path, time.time() - start)
+            raise
+        finally:
+            observer.acquire_finished(
+                self._path,
+                time.time() - start,
+                path is not None
+            )
+
+        if path:
+            self._held[path] = time.time()
+
+        return path
+
+    def _attempt_lock(self, timeout, waiter):
+        # the deadline covers every retry and wakeup, not each one
+        deadline = None if timeout is None else time.time() + timeout
+        retry = self._retry.copy()
+
+        def backoff(seconds):
+            # never sleep past the caller's timeout
+            if deadline is not None and time.time() + seconds >= deadline:
+                raise LockTimeout(
+                    self._TIMEOUT_ERR % (self._base_path, timeout)
+                )
 
-            try:
-                path = self.driver.create_lock(self._client, self.path)
-                lock_acquired = self._acquire(path, timeout)
-            except NoNodeError:
-                # TODO: need a retry here
-                finished = False
+            # on an event rather than with sleep, so cancel() cuts it short
+            waiter.event = self._client.handler.event_object()
+            waiter.check()
+            waiter.event.wait(seconds)
+            waiter.check()
+
+        def attempt():
+            waiter.check()
 
-        return path if lock_acquired else None
+            remaining = timeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise LockTimeout(
+                        self._TIMEOUT_ERR % (self._base_path, timeout)
+                    )
+
+            return self._attempt(remaining, waiter)
+
+        retry.sleep_func = backoff
+        return retry(attempt)
+
+    def create_lock(self):
+        # queues a node without waiting for it, for callers that work out
+        # for themselves whether it's acquired (see ReadWriteLock.upgrade)
+        protected_path = _protect(self.path)
+
+        try:
+            path = self._call(
+                "create",
+                self._driver.create_protected_lock,
+                self._client,
+                protected_path
+            )
+        except ConnectionLoss:
+            # the node may still exist, pick it up on the next sweep
+            self._orphans.add(protected_path)
+            raise
+
+        self._nodes.add(path[len(self._base_path) + 1:])
+        return path
 
     def release_lock(self, lock_path):
+        # asked while our node still keeps the directory around
+        containers = supports_containers(self._client, self._base_path)
         self._delete(lock_path)
 
+        if not containers:
+            # nobody else will remove the directory once it's empty
+            self.clean()
+
+        if self._observer is not None:
+            acquired_at = self._held.pop(lock_path, None)
+            if acquired_at is not None:
+                self._observer.released(
+                    self._path,
+                    time.time() - acquired_at
+                )
+
+        self.sweep()
+
+    def sweep(self):
+        # delete nodes whose create we never heard back about. They belong to
+        # our session, so otherwise they'd block everyone until it expires.
+        for protected_path in list(self._orphans):
+            try:
+                path = self._driver.find_lock(self._client, protected_path)
+                if path:
+                    self._delete(path)
+            except ConnectionLoss:
+                continue
+
+            self._orphans.discard(protected_path)
+
+    def owned_nodes(self):
+        # names of the nodes this instance has queued or holds
+        return list(self._nodes)
+
+    def watch_query(self, fn):
+        # evaluates fn against the participant index, which is kept up to
+        # date by a watch from now on (until unwatch), so repeated calls
+        # don't cost round trips
+        self._children.watch()
+        return self._children.query(fn)
+
+    def unwatch(self):
+        self._children.unwatch()
+
     def clean(self):
         try:
             self._client.delete(self._base_path)
@@ -85,28 +560,53 @@ class Lock(object):
         return list(nodes)
 
     def get_sorted_children(self):
-        def sortkey(path):
-            return self._driver.sort_key(path, self.name)
-
-        children = self._client.get_children(self._base_path)
-        children.sort(key=sortkey)
-        return children
+        children = self._call(
+            "get_children",
+            self._client.get_children,
+            self._base_path
+        )
+        return self._driver.create_index(self.name, children).nodes()
 
-    def _acquire(self, path, timeout):
+    def _acquire(self, path, timeout, driver=None, listing=None,
+                 waiter=None):
+        driver = driver or self._driver
         acquired = False
+        deadline = time.time() + timeout if timeout else None
         delete = False
 
-        try:
-            while self._client.connected and not acquired:
-                self._watch_handle.clear()
+        # every attempt gets its own event so that threads sharing this lock
+        # can wait concurrently without clearing each other's wakeups
+        watch_handle = self._client.handler.event_object()
+        if waiter is not None:
+            waiter.event = watch_handle
 
-                children = self.get_sorted_children()
-                name = path[len(self._base_path) + 1:]
+        def watcher(event):
+            # called for both our predecessor's watch and state changes
+            if getattr(event, "type", None) == EventType.DELETED:
+                self._children.discard(event.path.split("/")[-1])
 
-                path_to_watch, acquirable = self._driver.is_acquirable(
-                    children,
-                    name,
-                    self.max_leases
+            watch_handle.set()
+            return True
+
+        name = path[len(self._base_path) + 1:]
+        self._children.open()
+
+        try:
+            if listing is not None:
+                self._children.finish_refresh(listing)
+
+            while self._client.connected and not acquired:
+                watch_handle.clear()
+                if waiter is not None:
+                    waiter.check()
+
+                path_to_watch, acquirable = self._children.query(
+                    lambda index: driver.is_acquirable_in(
+                        index,
+                        name,
+                        self.max_leases
+                    ),
+                    require=name
                 )
 
                 if acquirable:
@@ -114,43 +614,108 @@ class Lock(object):
                     break
 
                 path_to_watch = make_path(self._base_path, path_to_watch)
-                self._client.add_listener(self._watcher)
-
-                with mutex(self._lock):
-                    try:
-                        if self._client.exists(path_to_watch, self._watcher):
-                            if timeout:
-                                self._watch_handle.wait(timeout)
-                            else:
-                                self._watch_handle.wait()
-
-                            if not self._watch_handle.isSet():
-                                raise LockTimeout(
-                                    self._TIMEOUT_ERR
-                                    % (self._base_path, timeout)
-                                )
-                    except NoNodeError:
-                        pass
-                    finally:
-                        self._client.remove_listener(self._watcher)
+                self._client.add_listener(watcher)
+
+                try:
+                    exists = self._call(
+                        "exists",
+                        self._client.exists,
+                        path_to_watch,
+                        watcher
+                    )
+
+                    if not exists:
+                        # gone already, no need to ask ZooKeeper again
+                        self._children.discard(path_to_watch.split("/")[-1])
+                    else:
+                        if deadline is None:
+                            watch_handle.wait()
+                        else:
+                            remaining = deadline - time.time()
+                            if remaining > 0:
+                                watch_handle.wait(remaining)
+
+                        if not watch_handle.is_set():
+                            raise LockTimeout(
+                                self._TIMEOUT_ERR % (self._base_path, timeout)
+                            )
+
+                        if waiter is not None:
+                            waiter.check()
+
+                        if self._observer is not None:
+                            self._observer.woke_up(self._path)
+                except NoNodeError:
+                    pass
+                finally:
+                    self._client.remove_listener(watcher)
         except:
             delete = True
             raise
         finally:
+            self._children.close()
+
             if delete:
                 self._delete(path)
 
         return acquired
 
+    def _attempt(self, timeout, waiter=None):
+        self.sweep()
+
+        try:
+            path, listing = self._create_and_list()
+            acquired = self._acquire(path, timeout, listing=listing,
+                                     waiter=waiter)
+        except NoNodeError:
+            # our node (or the lock directory) went away, start over
+            raise ForceRetryError()
+
+        return path if acquired else None
+
+    def _create_and_list(self):
+        # ZooKeeper answers a session's requests in order, so a listing sent
+        # right behind the create already includes our node. Sending both
+        # before waiting on either makes an uncontended acquire one round
+        # trip instead of two. Returns the node's path and the pending
+        # listing (None if the create didn't go through the first time).
+        protected_path = _protect(self.path)
+        created = self._driver.create_protected_lock_async(
+            self._client,
+            protected_path
+        )
+        listing = self._children.refresh_async()
+
+        def create():
+            path = self._driver.create_protected_lock(
+                self._client,
+                protected_path,
+                created
+            )
+
+            # the listing failed along with the create
+            return (path, listing if created.successful() else None)
+
+        try:
+            path, listing = self._call("create", create)
+        except ConnectionLoss:
+            # the node may still exist, pick it up on the next sweep
+            self._orphans.add(protected_path)
+            raise
+
+        self._nodes.add(path[len(self._base_path) + 1:])
+        return (path, listing)
+
+    def _call(self, operation, fn, *args):
+        return timed(self._observer, self._path, operation, fn, *args)
+
     def _delete(self, path):
         try:
-            self._client.delete(path)
+            self._call("delete", self._client.delete, path)
         except NoNodeError:
             pass
 
-    def _watcher(self, state):
-        self._watch_handle.set()
-        return True
+        self._nodes.discard(path[len(self._base_path) + 1:])
 
 
 class LockDriver(object):
@@ -165,13 +730,79 @@ class LockDriver(object):
             raise NoNodeError()
 
     def create_lock(self, client, path):
-        return client.create(
-            _protect(path),
+        return self.create_protected_lock(client, _protect(path))
+
+    def create_protected_lock(self, client, protected_path, created=None):
+        # `created` is the result of create_protected_lock_async, for a
+        # create that's already been sent
+        def create():
+            return client.create(
+                protected_path,
+                ephemeral=True,
+                sequence=True
+            )
+
+        try:
+            try:
+                return created.get() if created is not None else create()
+            except NoNodeError:
+                ensure_container(client, protected_path.rsplit("/", 1)[0])
+                return create()
+        except ConnectionLoss:
+            # the create may have been applied even though the response was
+            # lost, in which case our guid tells us which node is ours
+            path = self.find_lock(client, protected_path)
+            if not path:
+                raise
+
+            return path
+
+    def create_protected_lock_async(self, client, protected_path):
+        # unlike create_protected_lock, this doesn't create a missing lock
+        # directory (the result raises NoNodeError) or look for our node
+        # after a ConnectionLoss. Hand the result to create_protected_lock
+        # for that.
+        return client.create_async(
+            protected_path,
             ephemeral=True,
-            makepath=True,
             sequence=True
         )
 
+    def find_lock(self, client, protected_path):
+        base_path, prefix = protected_path.rsplit("/", 1)
+
+        try:
+            children = client.get_children(base_path)
+        except NoNodeError:
+            return None
+
+        for child in children:
+            if child.startswith(prefix):
+                return make_path(base_path, child)
+
+        return None
+
+    def create_lock_in(self, transaction, path):
+        transaction.create(_protect(path), ephemeral=True, sequence=True)
+
+    def is_acquirable_in(self, index, sequence_node_name, max_leases):
+        position = index.position(sequence_node_name)
+        if position is None:
+            raise NoNodeError()
+
+        acquirable = position < max_leases
+        watch_path = None
+        if not acquirable:
+            watch_path = index.at(position - max_leases).node
+
+        return (watch_path, acquirable)
+
+    def create_index(self, lock_name, nodes=()):
+        return ParticipantIndex(self.lock_names(lock_name), nodes)
+
+    def lock_names(self, lock_name):
+        return (lock_name,)
+
     def sort_key(self, string, lock_name):
         if lock_name not in string:
             return string
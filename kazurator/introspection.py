@@ -0,0 +1,57 @@
+# Point in time views of a lock directory, as returned by Mutex.snapshot and
+# ReadWriteLock.snapshot. They're built from the watched participant index,
+# so taking one doesn't cost a round trip once the watch is in place.
+# mutex_snapshots and read_write_snapshots build them in bulk for many paths.
+
+
+class LockSnapshot(object):
+    def __init__(self, holders, waiters, owned=()):
+        self._holders = holders
+        self._owned = set(owned)
+        self._waiters = waiters
+
+    @property
+    def is_locked(self):
+        return len(self._holders) > 0
+
+    @property
+    def holders(self):
+        return [participant.node for participant in self._holders]
+
+    @property
+    def waiters(self):
+        return [participant.node for participant in self._waiters]
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    @property
+    def position(self):
+        # where our earliest node is (0 being the front of the queue), or
+        # None if this instance has nothing queued or held
+        if not self._owned:
+            return None
+
+        participants = self._holders + self._waiters
+        for position, participant in enumerate(participants):
+            if participant.node in self._owned:
+                return position
+
+        return None
+
+    def count_waiting(self, lock_name):
+        return sum(1 for p in self._waiters if p.lock_name == lock_name)
+
+    def _named(self, lock_name):
+        participants = self._holders + self._waiters
+        return [p.node for p in participants if p.lock_name == lock_name]
+
+
+def mutex_snapshot(index, max_leases, owned=()):
+    participants = list(index)
+    return LockSnapshot(
+        participants[:max_leases],
+        participants[max_leases:],
+        owned
+    )
@@ -0,0 +1,186 @@
+from kazoo.exceptions import (
+    LockTimeout,
+    NoNodeError,
+    RolledBackError,
+    RuntimeInconsistency
+)
+from sys import maxsize
+from threading import ThreadError
+from time import time
+from .internals import (
+    Lock,
+    LockDriver,
+    ensure_container,
+    supports_containers
+)
+from .mutex import DEFAULT_LOCK_NAME
+from .read_write_lock import (
+    READ_LOCK_NAME,
+    WRITE_LOCK_NAME,
+    _LockDriver,
+    _ReadLockDriver,
+    _read_is_acquirable
+)
+from .utils import mutex
+
+
+class LockSet(object):
+    _TIMEOUT_ERR = "Failed to acquire locks on %s after %s seconds"
+
+    # Acquires a group of locks as a unit. Every lock node is created in a
+    # single transaction, so all of them land in each lock directory at the
+    # same point in the global order. Two sets can't end up holding each
+    # other's next lock, and the waits happen in sorted path order. The
+    # nodes are the same ones Mutex and ReadWriteLock create, so the set
+    # contends fairly with them (and with curator).
+    #
+    #   with LockSet(client, writes=["/a"], reads=["/b", "/c"]):
+    #       ...
+    def __init__(self, client, mutexes=(), reads=(), writes=(), timeout=None):
+        self._client = client
+        self._nodes = None
+        self._sync_lock = client.handler.lock_object()
+        self._timeout = timeout
+
+        locks = {}
+        kinds = (
+            (mutexes, LockDriver(), DEFAULT_LOCK_NAME, 1),
+            (reads, _ReadLockDriver(_read_is_acquirable), READ_LOCK_NAME,
+             maxsize),
+            (writes, _LockDriver(), WRITE_LOCK_NAME, 1)
+        )
+
+        for paths, driver, name, max_leases in kinds:
+            for path in paths:
+                if path in locks:
+                    raise ValueError("Path is in the lock set twice: " + path)
+
+                locks[path] = Lock(client, driver, path, name, max_leases)
+
+        self._paths = sorted(locks)
+        self._locks = [locks[path] for path in self._paths]
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @property
+    def paths(self):
+        return list(self._paths)
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+
+    @property
+    def is_acquired(self):
+        return self._nodes is not None
+
+    def acquire(self):
+        with mutex(self._sync_lock):
+            if self._nodes is not None:
+                raise ThreadError("Lock set is already acquired")
+
+            deadline = None
+            if self._timeout:
+                deadline = time() + self._timeout
+
+            acquired = None
+
+            while acquired is None:
+                nodes = self._create_locks()
+                acquired = False
+
+                try:
+                    acquired = self._acquire(nodes, deadline)
+                except NoNodeError:
+                    # one of our nodes went away (e.g. the session expired)
+                    acquired = None
+                finally:
+                    if not acquired:
+                        self._delete(nodes)
+
+            if acquired:
+                self._nodes = nodes
+
+            return acquired
+
+    def release(self):
+        with mutex(self._sync_lock):
+            if self._nodes is None:
+                raise ThreadError("You do not own the lock set")
+
+            nodes = self._nodes
+            containers = supports_containers(self._client, self._paths[0])
+
+            transaction = self._client.transaction()
+            for node in nodes:
+                transaction.delete(node)
+
+            failures = _failures(transaction.commit())
+            if failures:
+                self._delete(nodes)
+
+            # not until the nodes are gone, so a release that raised can be
+            # tried again
+            self._nodes = None
+
+            if not failures and not containers:
+                for lock in self._locks:
+                    lock.clean()
+
+    def _acquire(self, nodes, deadline):
+        for lock, node in zip(self._locks, nodes):
+            timeout = None
+
+            if deadline is not None:
+                timeout = deadline - time()
+                if timeout <= 0:
+                    raise LockTimeout(
+                        self._TIMEOUT_ERR % (self.paths, self._timeout)
+                    )
+
+            if not lock._acquire(node, timeout):
+                return False
+
+        return True
+
+    def _create_locks(self):
+        while True:
+            transaction = self._client.transaction()
+            for lock in self._locks:
+                lock.driver.create_lock_in(transaction, lock.path)
+
+            results = transaction.commit()
+            failures = _failures(results)
+
+            if not failures:
+                return results
+
+            if not all(isinstance(err, NoNodeError) for err in failures):
+                raise failures[0]
+
+            # transactions can't makepath, so create the lock directories
+            # and go again
+            for lock in self._locks:
+                ensure_container(self._client, lock.path.rsplit("/", 1)[0])
+
+    def _delete(self, nodes):
+        for lock, node in zip(self._locks, nodes):
+            lock.release_lock(node)
+
+
+def _failures(results):
+    # the ops around the one that failed come back as rolled back or
+    # inconsistent, they're just noise
+    return [
+        result for result in results
+        if isinstance(result, Exception)
+        and not isinstance(result, (RolledBackError, RuntimeInconsistency))
+    ]
@@ -1,20 +1,78 @@
-from threading import current_thread, Lock as ThreadLock, ThreadError
-from .internals import Lock, LockDriver
-from .utils import mutex
+from threading import Lock as ThreadLock, ThreadError
+from kazoo.exceptions import NoNodeError, ZookeeperError
+from kazoo.protocol.states import KazooState
+from .internals import Lock, LockDriver, fetch_children
+from .introspection import mutex_snapshot
+from .participants import parse
+from .utils import mutex, owner_getter
 
 DEFAULT_LOCK_NAME = "lock-"
 
 
+class LockHandle(object):
+    # What acquire() returns. `token` is a fencing token: pass it along with
+    # writes to a downstream store, and have the store reject anything older
+    # than the newest token it has seen.
+    #
+    # The token is the lock node's creation zxid rather than its sequence
+    # number, since sequence numbers start over whenever the lock directory is
+    # deleted and recreated (which containers and the reaper do). It costs
+    # one round trip the first time it's asked for.
+    def __init__(self, client, path, lock_names=(DEFAULT_LOCK_NAME,)):
+        self._client = client
+        self._lock_names = lock_names
+        self._lost = False
+        self._path = path
+        self._token = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def sequence(self):
+        # the server's counter is a signed int, so once it wraps the suffix
+        # is negative (and not necessarily 10 characters)
+        node = self._path.rsplit("/", 1)[-1]
+        return parse(node, self._lock_names).sequence
+
+    @property
+    def is_lost(self):
+        # set once the connection is suspended or the session is lost, after
+        # which the lock may belong to someone else
+        return self._lost
+
+    @property
+    def token(self):
+        if self._token is None:
+            stat = self._client.exists(self._path)
+            if stat is None:
+                self._lost = True
+                raise NoNodeError("Lock node is gone: " + self._path)
+
+            self._token = stat.czxid
+
+        return self._token
+
+    def _mark_lost(self):
+        self._lost = True
+
+
 class _LockData(object):
-    def __init__(self, path):
+    def __init__(self, path, lock=None, handle=None):
         self._count = 1
-        self._lock = ThreadLock()
+        self._handle = handle
+        self._lock = lock or ThreadLock()
         self._path = path
 
     @property
     def path(self):
         return self._path
 
+    @property
+    def handle(self):
+        return self._handle
+
     @property
     def count(self):
         with mutex(self._lock):
@@ -33,21 +91,30 @@ class _LockData(object):
 
 class Mutex(object):
     def __init__(self, client, path, max_leases=1, **kwargs):
+        self._client = client
+        self._contended = False
+        self._current_owner = owner_getter(client.handler)
+        self._handler = client.handler
+        self._parked = None
         self._path = path
+        self._sticky = kwargs.get("sticky", False)
         self._sync_lock = client.handler.lock_object()
         self._thread_data = {}
         self._timeout = kwargs.get("timeout")
+        self._watched = None
 
         self._lock = Lock(
             client,
             kwargs.get("driver", LockDriver()),
             path,
             kwargs.get("name", DEFAULT_LOCK_NAME),
-            max_leases
+            max_leases,
+            kwargs.get("retry"),
+            kwargs.get("observer")
         )
 
     def __enter__(self):
-        self.acquire()
+        return self.acquire()
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.release()
@@ -75,14 +142,183 @@ class Mutex(object):
     @property
     def is_owned_by_current_thread(self):
         with mutex(self._sync_lock):
-            data = self._thread_data.get(current_thread())
+            data = self._thread_data.get(self._current_owner())
             return data and data.count > 0
 
+    @property
+    def handle(self):
+        # the current thread's handle, or None if it doesn't hold the lock
+        with mutex(self._sync_lock):
+            data = self._thread_data.get(self._current_owner())
+            return data and data.handle
+
     def get_participant_nodes(self):
         return self._lock.get_participant_nodes()
 
+    def snapshot(self):
+        return self._snapshot(self._lock.owned_nodes())
+
+    def unwatch(self):
+        self._lock.unwatch()
+
+    def cancel(self):
+        # aborts acquire() calls waiting on this instance (from any thread):
+        # they delete their queued node and raise CancelledError
+        self._lock.cancel()
+
+    def flush(self):
+        # with sticky=True, deletes the node kept after the last release
+        with mutex(self._sync_lock):
+            path = self._parked
+            self._parked = None
+
+        if path:
+            self._release_node(path)
+
+    def _owned_path(self):
+        # the node the current thread (or greenlet) holds, for handing it over
+        with mutex(self._sync_lock):
+            data = self._thread_data.get(self._current_owner())
+
+        if not data:
+            raise ThreadError("You do not own the lock: " + self._path)
+
+        if data.count != 1:
+            raise ThreadError("Lock has been re-entered: " + self._path)
+
+        return data.path
+
+    def _adopt(self, path):
+        with mutex(self._sync_lock):
+            return self._hold(self._current_owner(), path)
+
+    def _forget(self):
+        with mutex(self._sync_lock):
+            path = self._thread_data[self._current_owner()].path
+            if self._watched == path:
+                # it's someone else's node now
+                self._watched = None
+                self._contended = False
+
+            self._drop(self._current_owner())
+
+    def _hold(self, owner, path):
+        if not self._thread_data:
+            # only listen while something is held
+            self._client.add_listener(self._listener)
+
+        handle = LockHandle(
+            self._client,
+            path,
+            self._lock.driver.lock_names(self._lock.name)
+        )
+        self._thread_data[owner] = _LockData(
+            path,
+            self._handler.lock_object(),
+            handle
+        )
+
+        return handle
+
+    def _drop(self, owner):
+        del self._thread_data[owner]
+        self._stop_listening()
+
+    def _stop_listening(self):
+        if not self._thread_data and self._parked is None:
+            self._client.remove_listener(self._listener)
+
+    def _listener(self, state):
+        if state not in (KazooState.SUSPENDED, KazooState.LOST):
+            return
+
+        with mutex(self._sync_lock):
+            for data in self._thread_data.values():
+                data.handle._mark_lost()
+
+            if self._thread_data:
+                # a node held through this can't be trusted any more, so it
+                # gets released for real rather than kept
+                self._contended = True
+
+            # a kept node survives a suspension along with the session (and
+            # isn't handed out until we're connected again), but not a lost
+            # session
+            parked = state == KazooState.LOST and self._parked
+            if parked:
+                self._parked = None
+                self._watched = None
+                self._stop_listening()
+
+    def _watch_contenders(self, path):
+        # keeps a sticky node (parked or held) until another node shows up
+        # in the lock directory. The watch is set once per node, so
+        # uncontended acquire/release cycles don't touch ZooKeeper.
+        with mutex(self._sync_lock):
+            if self._watched == path:
+                return
+
+            self._watched = path
+
+        name = path.rsplit("/", 1)[1]
+
+        def watch(event=None):
+            with mutex(self._sync_lock):
+                if self._watched != path:
+                    return
+
+            try:
+                children = self._client.get_children(self._path, watch)
+            except NoNodeError:
+                children = []
+            except ZookeeperError:
+                # no watch is set, so we'd never hear about contenders: give
+                # the node up (a held one once it's released)
+                children = None
+
+            if children is None or name not in children or len(children) > 1:
+                self._contend(path)
+
+        watch()
+
+    def _contend(self, path):
+        with mutex(self._sync_lock):
+            if self._watched != path:
+                return
+
+            self._contended = True
+            parked = self._parked == path
+            if parked:
+                self._parked = None
+
+        if parked:
+            self._release_node(path)
+
+    def _release_node(self, path):
+        with mutex(self._sync_lock):
+            if self._watched == path:
+                self._watched = None
+                self._contended = False
+
+            self._stop_listening()
+
+        self._lock.release_lock(path)
+
+    def _snapshot(self, owned):
+        fn = self._snapshot_fn(owned)
+
+        try:
+            return self._lock.watch_query(fn)
+        except NoNodeError:
+            # nobody has used this lock yet
+            return fn(self._lock.driver.create_index(self._lock.name))
+
+    def _snapshot_fn(self, owned):
+        max_leases = self._lock.max_leases
+        return lambda index: mutex_snapshot(index, max_leases, owned)
+
     def acquire(self):
-        thread = current_thread()
+        thread = self._current_owner()
 
         with mutex(self._sync_lock):
             data = self._thread_data.get(thread)
@@ -90,17 +326,32 @@ class Mutex(object):
             if data:
                 # re-entering
                 data.increment()
-                return True
+                return data.handle
+
+            connected = self._client.state == KazooState.CONNECTED
+            if self._parked is not None and connected:
+                # nobody else has shown up since we let go, so the node we
+                # kept is still at the front of the queue
+                path = self._parked
+                self._parked = None
+                return self._hold(thread, path)
 
-            path = self._lock.attempt_lock(self._timeout)
-            if not path:
-                return False
+        # only the bookkeeping is guarded by _sync_lock; the round trips and
+        # the wait happen outside of it so other threads can queue, check
+        # ownership or release while we block
+        path = self._lock.attempt_lock(self._timeout)
+        if not path:
+            return False
 
-            self._thread_data[thread] = _LockData(path)
-            return True
+        with mutex(self._sync_lock):
+            if self._watched is None:
+                # whatever made us give up a kept node is over and done with
+                self._contended = False
+
+            return self._hold(thread, path)
 
     def release(self):
-        thread = current_thread()
+        thread = self._current_owner()
 
         with mutex(self._sync_lock):
             data = self._thread_data.get(thread)
@@ -116,8 +367,26 @@ class Mutex(object):
             if count < 0:
                 raise ThreadError("Lock count has gone negative: " + path)
 
+            park = count == 0 and self._sticky and not self._contended
+            if park:
+                self._parked = data.path
+
             if count == 0:
-                try:
-                    self._lock.release_lock(data.path)
-                finally:
-                    del self._thread_data[thread]
+                self._drop(thread)
+
+        if park:
+            self._watch_contenders(data.path)
+        elif count == 0:
+            self._release_node(data.path)
+
+
+def mutex_snapshots(client, paths, max_leases=1, name=DEFAULT_LOCK_NAME,
+                    concurrency=100):
+    # Snapshots of many mutexes, listing each directory once with pipelined
+    # requests (see fetch_children). Yields (path, snapshot) pairs as they
+    # arrive, in the order given.
+    driver = LockDriver()
+
+    for path, children in fetch_children(client, paths, concurrency):
+        index = driver.create_index(name, children or ())
+        yield (path, mutex_snapshot(index, max_leases))
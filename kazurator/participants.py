@@ -0,0 +1,204 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+_GUID_PREFIX = "_c_"
+_GUID_LENGTH = 36
+_SEQUENCE_SPACE = 2 ** 32
+
+# A lock node, parsed once. `sequence` is the raw (signed 32 bit) counter
+# ZooKeeper appended to the name and `guid` is the protection id from
+# internals._protect (None for unprotected nodes).
+Participant = namedtuple("Participant", "node sequence lock_name guid")
+
+
+def parse(node, lock_names):
+    for lock_name in lock_names:
+        index = node.rfind(lock_name)
+        if index < 0:
+            continue
+
+        try:
+            sequence = int(node[index + len(lock_name):])
+        except ValueError:
+            continue
+
+        guid = None
+        if node.startswith(_GUID_PREFIX):
+            guid = node[len(_GUID_PREFIX):len(_GUID_PREFIX) + _GUID_LENGTH]
+
+        return Participant(node, sequence, lock_name, guid)
+
+    return None
+
+
+class ParticipantIndex(object):
+    # The lock nodes of a directory in acquisition order, keyed by sequence
+    # number rather than by zero padded string, so finding a node (and the
+    # one in front of it) is a dict lookup plus a bisect.
+    #
+    # ZooKeeper's sequence counter is a signed 32 bit int and wraps from
+    # 2147483647 to -2147483648. Live nodes are always well within 2^31 of
+    # each other, so each sequence is unwrapped to the value closest to the
+    # last one we saw, which keeps keys ordered across the wrap.
+    #
+    # The keys of each lock name are also kept separately, so questions like
+    # "is there a writer ahead of me" don't have to walk the whole directory.
+    def __init__(self, lock_names, nodes=(), parse=parse):
+        self._by_name = {}
+        self._by_node = {}
+        self._keys = []
+        self._lock_names = lock_names
+        self._parse = parse
+        self._participants = []
+        self._reference = None
+
+        self.update(nodes)
+
+    def __len__(self):
+        return len(self._participants)
+
+    def __iter__(self):
+        return iter(self._participants)
+
+    def __contains__(self, node):
+        return node in self._by_node
+
+    def nodes(self):
+        return [participant.node for participant in self._participants]
+
+    def at(self, position):
+        return self._participants[position]
+
+    def get(self, node):
+        position = self.position(node)
+        return None if position is None else self._participants[position]
+
+    def position(self, node):
+        key = self._by_node.get(node)
+        if key is None:
+            return None
+
+        return bisect_left(self._keys, key)
+
+    def count(self, lock_name):
+        return len(self._by_name.get(lock_name, ()))
+
+    def first(self, lock_name, before=None):
+        # the earliest participant with lock_name, optionally only if it is
+        # ahead of the node `before`
+        keys = self._by_name.get(lock_name)
+        if not keys:
+            return None
+
+        if before is not None:
+            bound = self._by_node.get(before)
+            if bound is None or keys[0] >= bound:
+                return None
+
+        return self._participants[bisect_left(self._keys, keys[0])]
+
+    def add(self, node):
+        if node in self._by_node:
+            return False
+
+        participant = self._parse(node, self._lock_names)
+        if participant is None:
+            return False
+
+        key = self._unwrap(participant.sequence)
+        index = bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self._participants.insert(index, participant)
+        self._by_node[node] = key
+
+        keys = self._by_name.setdefault(participant.lock_name, [])
+        keys.insert(bisect_right(keys, key), key)
+        return True
+
+    def discard(self, node):
+        position = self.position(node)
+        if position is None:
+            return False
+
+        key = self._keys.pop(position)
+        participant = self._participants.pop(position)
+        del self._by_node[node]
+
+        keys = self._by_name[participant.lock_name]
+        del keys[bisect_left(keys, key)]
+
+        if not self._keys:
+            self._reference = None
+
+        return True
+
+    def update(self, nodes):
+        if self._participants:
+            for node in nodes:
+                self.add(node)
+
+            return
+
+        # building from scratch, so sort once instead of inserting
+        by_node = self._by_node
+        lock_names = self._lock_names
+        parsed = []
+        unwrap = self._unwrap
+
+        for node in nodes:
+            participant = self._parse(node, lock_names)
+            if participant is not None and node not in by_node:
+                key = unwrap(participant.sequence)
+                by_node[node] = key
+                parsed.append((key, participant))
+
+        parsed.sort(key=lambda item: item[0])
+        self._set(parsed)
+
+    def replace(self, nodes):
+        # bring the index in line with a fresh listing of the directory
+        nodes = set(nodes)
+        removed = [node for node in self._by_node if node not in nodes]
+
+        if len(removed) > len(self._participants) // 8:
+            removed = set(removed)
+            kept = [
+                (key, participant)
+                for key, participant in zip(self._keys, self._participants)
+                if participant.node not in removed
+            ]
+
+            for node in removed:
+                del self._by_node[node]
+
+            self._set(kept)
+
+            if not self._keys:
+                self._reference = None
+        else:
+            for node in removed:
+                self.discard(node)
+
+        self.update(node for node in nodes if node not in self._by_node)
+
+    def _set(self, items):
+        # items are (key, participant) pairs, already sorted
+        self._by_name = {}
+        self._keys = [key for key, _ in items]
+        self._participants = [participant for _, participant in items]
+
+        for key, participant in items:
+            self._by_name.setdefault(participant.lock_name, []).append(key)
+
+    def _unwrap(self, sequence):
+        if self._reference is None:
+            self._reference = sequence
+            return sequence
+
+        delta = (sequence - self._reference) % _SEQUENCE_SPACE
+        if delta >= _SEQUENCE_SPACE // 2:
+            delta -= _SEQUENCE_SPACE
+
+        key = self._reference + delta
+        self._reference = max(self._reference, key)
+        return key
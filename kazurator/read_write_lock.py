@@ -1,14 +1,26 @@
-from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import LockTimeout, NoNodeError, ZookeeperError
+from kazoo.protocol.states import KazooState
 from sys import maxsize
+from threading import Lock as ThreadLock, ThreadError
+from time import time
 from .mutex import Mutex
-from .internals import LockDriver
-from .utils import lazyproperty
+from .internals import LockDriver, fetch_children
+from .introspection import LockSnapshot
+from .utils import lazyproperty, mutex
 
 READ_LOCK_NAME = "__READ__"
 WRITE_LOCK_NAME = "__WRIT__"
 
+# read leases shared by every thread in this process (see _SharedReadLock)
+_shared_lock = ThreadLock()
+_shared_leases = {}
+_held_leases = {}
+
 
 class _LockDriver(LockDriver):
+    def lock_names(self, _lock_name):
+        return (READ_LOCK_NAME, WRITE_LOCK_NAME)
+
     def sort_key(self, string, _lock_name):
         string = super(_LockDriver, self).sort_key(string, READ_LOCK_NAME)
         string = super(_LockDriver, self).sort_key(string, WRITE_LOCK_NAME)
@@ -16,34 +28,300 @@ class _LockDriver(LockDriver):
 
 
 class _ReadLockDriver(_LockDriver):
-    def __init__(self, predicate):
+    def __init__(self, predicate, index_predicate=None):
         super(_ReadLockDriver, self).__init__()
+        self._index_predicate = index_predicate
         self._predicate = predicate
 
     def is_acquirable(self, children, sequence_node_name, max_leases):
         return self._predicate(children, sequence_node_name)
 
+    def is_acquirable_in(self, index, sequence_node_name, max_leases):
+        if self._index_predicate is None:
+            return self._predicate(index.nodes(), sequence_node_name)
+
+        return self._index_predicate(index, sequence_node_name)
+
+
+class _UpgradeDriver(_LockDriver):
+    # the write side of an upgrade: our own read node doesn't count against
+    # us, since it goes away as soon as the write node is acquired
+    def __init__(self, read_node):
+        super(_UpgradeDriver, self).__init__()
+        self._read_node = read_node
+
+    def is_acquirable_in(self, index, sequence_node_name, max_leases):
+        position = index.position(sequence_node_name)
+        if position is None:
+            raise NoNodeError()
+
+        ignored = index.position(self._read_node)
+        if ignored is not None and ignored < position:
+            position -= 1
+
+        if position < max_leases:
+            return (None, True)
+
+        watch = position - max_leases
+        if ignored is not None and ignored <= watch:
+            watch += 1
+
+        return (index.at(watch).node, False)
+
 
 class _Mutex(Mutex):
-    def __init__(self, client, path, name, max_leases, driver, timeout):
+    def __init__(self, client, path, name, max_leases, driver, timeout,
+                 retry=None, observer=None, sticky=False):
         super(_Mutex, self).__init__(
             client,
             path,
             max_leases,
             name=name,
             driver=driver,
-            timeout=timeout
+            timeout=timeout,
+            retry=retry,
+            observer=observer,
+            sticky=sticky
         )
 
     def get_participant_nodes(self):
         nodes = super(_Mutex, self).get_participant_nodes()
         return list(filter(lambda node: self.name in node, nodes))
 
+    def _snapshot_fn(self, owned):
+        return lambda index: read_write_snapshot(index, owned)
+
+
+class _SharedLease(object):
+    def __init__(self, key):
+        self.closed = False
+        self.count = 1
+        self.key = key
+        self.listener = None
+        self.path = None
+        self.waiting = set()  # events of readers waiting to join
+
+    @property
+    def joinable(self):
+        return self.path is not None and not self.closed
+
+
+class _SharedReadLock(object):
+    _TIMEOUT_ERR = "Failed to acquire a lock on %s after %s seconds"
+
+    # Stands in for internals.Lock on the read side of a ReadWriteLock. The
+    # first reader in the process queues a node as usual, and later readers
+    # (on any thread or instance using the same client and path) bump a
+    # reference count on it instead of creating their own. Once a writer
+    # shows up in the lock directory the lease stops accepting new readers,
+    # so they queue behind the writer like everyone else.
+    def __init__(self, lock, write_lock):
+        self._lock = lock
+        self._write_lock = write_lock
+
+    @property
+    def name(self):
+        return self._lock.name
+
+    @property
+    def driver(self):
+        return self._lock.driver
+
+    @property
+    def max_leases(self):
+        return self._lock.max_leases
+
+    def get_participant_nodes(self):
+        return self._lock.get_participant_nodes()
+
+    def owned_nodes(self):
+        return self._lock.owned_nodes()
+
+    def watch_query(self, fn):
+        return self._lock.watch_query(fn)
+
+    def unwatch(self):
+        self._lock.unwatch()
+
+    def cancel(self):
+        self._lock.cancel()
+
+    def attempt_lock(self, timeout=None):
+        if self._write_lock.is_owned_by_current_thread:
+            # we may be what everyone else is waiting on
+            return self._lock.attempt_lock(timeout)
+
+        key = (self._lock.client, self._lock.path)
+
+        # the deadline covers waiting to join as well as the attempt itself
+        deadline = None if timeout is None else time() + timeout
+
+        with self._lock.waiting() as waiter:
+            while True:
+                waiter.event = self._lock.client.handler.event_object()
+
+                with mutex(_shared_lock):
+                    lease = _shared_leases.get(key)
+
+                    if lease is None:
+                        lease = _shared_leases[key] = _SharedLease(key)
+                        break
+
+                    if lease.joinable:
+                        lease.count += 1
+                        return lease.path
+
+                    lease.waiting.add(waiter.event)
+
+                try:
+                    # another reader is queueing for the lease, see whether
+                    # it gets it
+                    waiter.check()
+                    self._wait(waiter.event, deadline, timeout)
+                    waiter.check()
+                finally:
+                    with mutex(_shared_lock):
+                        lease.waiting.discard(waiter.event)
+
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time(), 0)
+
+            return self._attempt_lease(lease, remaining, waiter)
+
+    def _wait(self, event, deadline, timeout):
+        if deadline is None:
+            event.wait()
+        else:
+            remaining = deadline - time()
+            if remaining > 0:
+                event.wait(remaining)
+
+        if not event.is_set():
+            raise LockTimeout(self._TIMEOUT_ERR % (self._lock.path, timeout))
+
+    def _attempt_lease(self, lease, timeout, waiter):
+        path = None
+
+        try:
+            path = self._lock.attempt_lock(timeout, waiter)
+            if path:
+                self._watch_writers(lease, path)
+        finally:
+            with mutex(_shared_lock):
+                if path:
+                    lease.path = path
+                    _held_leases[path] = lease
+                else:
+                    self._close(lease)
+
+                waiting = list(lease.waiting)
+
+            for event in waiting:
+                event.set()
+
+        return path
+
+    def release_lock(self, lock_path):
+        with mutex(_shared_lock):
+            lease = _held_leases.get(lock_path)
+
+            if lease:
+                lease.count -= 1
+                if lease.count > 0:
+                    return
+
+                del _held_leases[lock_path]
+                self._close(lease)
+
+        self._lock.release_lock(lock_path)
+
+    def _reopen(self, lease):
+        # the writer watch goes first, so nobody joins past a queued writer
+        with mutex(_shared_lock):
+            lease.closed = False
+
+        self._watch_writers(lease, lease.path)
+
+        with mutex(_shared_lock):
+            if lease.closed:
+                return
+
+            if lease.key in _shared_leases:
+                # a new lease started while this one was closed
+                self._close(lease)
+            else:
+                _shared_leases[lease.key] = lease
+
+    def _close(self, lease):
+        lease.closed = True
+        if _shared_leases.get(lease.key) is lease:
+            del _shared_leases[lease.key]
+
+        if lease.listener is not None:
+            self._lock.client.remove_listener(lease.listener)
+            lease.listener = None
+
+    def _watch_writers(self, lease, path):
+        client = self._lock.client
+        base_path, node = path.rsplit("/", 1)
+
+        def listener(state):
+            # the node went with the session
+            if state == KazooState.LOST:
+                with mutex(_shared_lock):
+                    self._close(lease)
+
+        def watch(event=None):
+            if lease.closed:
+                return
+
+            try:
+                children = client.get_children(base_path, watch)
+                closing = node not in children or \
+                    any(WRITE_LOCK_NAME in child for child in children)
+            except ZookeeperError:
+                closing = True
+
+            if closing:
+                with mutex(_shared_lock):
+                    self._close(lease)
+
+        with mutex(_shared_lock):
+            lease.listener = listener
+            client.add_listener(listener)
+
+        watch()
+
+
+class _SharedReadMutex(_Mutex):
+    def __init__(self, client, path, name, max_leases, driver, timeout,
+                 write_lock, retry=None, observer=None):
+        super(_SharedReadMutex, self).__init__(
+            client,
+            path,
+            name,
+            max_leases,
+            driver,
+            timeout,
+            retry,
+            observer
+        )
+
+        self._lock = _SharedReadLock(self._lock, write_lock)
+
 
 class ReadWriteLock(object):
-    def __init__(self, client, path, timeout=None):
+    _SIDES = ("read_lock", "write_lock")
+
+    def __init__(self, client, path, timeout=None, share_reads=False,
+                 retry=None, observer=None, sticky_writes=False):
         self._client = client
+        self._observer = observer
         self._path = path
+        self._retry = retry
+        self._share_reads = share_reads
+        self._sticky_writes = sticky_writes
         self._timeout = timeout
 
     @property
@@ -60,12 +338,31 @@ class ReadWriteLock(object):
         self.read_lock.timeout = value
         self.write_lock.timeout = value
 
+    @property
+    def is_acquired(self):
+        # only looks at the sides that have been used, so asking doesn't
+        # create them
+        locks = [self.__dict__.get(name) for name in self._SIDES]
+        return any(lock.is_acquired for lock in locks if lock is not None)
+
     @lazyproperty
     def read_lock(self):
-        def predicate(children, sequence_node_name):
-            return self._read_is_acquirable_predicate(
-                children,
-                sequence_node_name
+        driver = _ReadLockDriver(
+            self._read_is_acquirable_predicate,
+            self._read_is_acquirable_in_predicate
+        )
+
+        if self._share_reads:
+            return _SharedReadMutex(
+                self._client,
+                self.path,
+                READ_LOCK_NAME,
+                maxsize,
+                driver,
+                self.timeout,
+                self.write_lock,
+                self._retry,
+                self._observer
             )
 
         return _Mutex(
@@ -73,8 +370,10 @@ class ReadWriteLock(object):
             self.path,
             READ_LOCK_NAME,
             maxsize,
-            _ReadLockDriver(predicate),
-            self.timeout
+            driver,
+            self.timeout,
+            self._retry,
+            self._observer
         )
 
     @lazyproperty
@@ -85,7 +384,10 @@ class ReadWriteLock(object):
             WRITE_LOCK_NAME,
             1,
             _LockDriver(),
-            self.timeout
+            self.timeout,
+            self._retry,
+            self._observer,
+            self._sticky_writes
         )
 
     def get_participant_nodes(self):
@@ -93,26 +395,209 @@ class ReadWriteLock(object):
         nodes.extend(self.write_lock.get_participant_nodes())
         return nodes
 
+    def downgrade(self):
+        # Swaps the write lock held by this thread for a read lock, without
+        # letting another writer in between. That only works if no writer
+        # queued up before our read node did, otherwise False is returned
+        # and the write lock is still held.
+        write_path = self.write_lock._owned_path()
+        if self.read_lock.is_owned_by_current_thread:
+            raise ThreadError("Read lock is already held: " + self.path)
+
+        lock = self._read_internals()
+        path = lock.create_lock()
+        acquirable = False
+
+        try:
+            name = path[len(self.path) + 1:]
+            index = lock.driver.create_index(
+                READ_LOCK_NAME,
+                self._client.get_children(self.path)
+            )
+            index.discard(write_path[len(self.path) + 1:])
+
+            acquirable = _read_is_acquirable_in(index, name)[1]
+        finally:
+            if not acquirable:
+                lock._delete(path)
+
+        if not acquirable:
+            return False
+
+        self.write_lock._forget()
+        self.write_lock._lock.release_lock(write_path)
+        self.read_lock._adopt(path)
+        return True
+
+    def upgrade(self):
+        # Swaps the read lock held by this thread for the write lock. Our
+        # write node waits for the other readers ahead of it but no writer
+        # can get in first, so nothing changes under us. Returns False (still
+        # holding the read lock) if another writer is already queued, since
+        # we'd be waiting on each other.
+        read_path = self.read_lock._owned_path()
+        if self.write_lock.is_owned_by_current_thread:
+            raise ThreadError("Write lock is already held: " + self.path)
+
+        with mutex(_shared_lock):
+            lease = _held_leases.get(read_path)
+            if lease is not None:
+                if lease.count > 1:
+                    # other threads are reading through the same node
+                    return False
+
+                # and nobody may start to while we upgrade it
+                self.read_lock._lock._close(lease)
+
+        upgraded = False
+        try:
+            upgraded = self._upgrade(read_path)
+        finally:
+            if lease is not None and not upgraded:
+                # still reading through it, so others may join again
+                self.read_lock._lock._reopen(lease)
+
+        return upgraded
+
+    def snapshot(self):
+        # both sides share a directory, so one watch covers them
+        owned = self.read_lock._lock.owned_nodes()
+        owned.extend(self.write_lock._lock.owned_nodes())
+        return self.write_lock._snapshot(owned)
+
+    def cancel(self):
+        # aborts waiting acquires on both sides
+        for name in self._SIDES:
+            lock = self.__dict__.get(name)
+            if lock is not None:
+                lock.cancel()
+
+    def unwatch(self):
+        self.write_lock.unwatch()
+
+    def _upgrade(self, read_path):
+        lock = self.write_lock._lock
+        path = lock.create_lock()
+        acquired = False
+
+        try:
+            name = path[len(self.path) + 1:]
+            index = lock.driver.create_index(
+                WRITE_LOCK_NAME,
+                self._client.get_children(self.path)
+            )
+
+            if index.first(WRITE_LOCK_NAME).node == name:
+                driver = _UpgradeDriver(read_path[len(self.path) + 1:])
+                with lock.waiting() as waiter:
+                    acquired = lock._acquire(path, self.timeout, driver,
+                                             waiter=waiter)
+        finally:
+            if not acquired:
+                lock._delete(path)
+
+        if not acquired:
+            return False
+
+        self.read_lock._forget()
+        self.read_lock._lock.release_lock(read_path)
+        self.write_lock._adopt(path)
+        return True
+
+    def _read_internals(self):
+        lock = self.read_lock._lock
+        if isinstance(lock, _SharedReadLock):
+            return lock._lock
+
+        return lock
+
     def _read_is_acquirable_predicate(self, children, sequence_node_name):
         if self.write_lock.is_owned_by_current_thread:
             return (None, True)
 
-        index = 0
-        write_index = maxsize
-        our_index = -1
+        return _read_is_acquirable(children, sequence_node_name)
+
+    def _read_is_acquirable_in_predicate(self, index, sequence_node_name):
+        if self.write_lock.is_owned_by_current_thread:
+            return (None, True)
+
+        return _read_is_acquirable_in(index, sequence_node_name)
+
+
+class ReadWriteSnapshot(LockSnapshot):
+    @property
+    def readers(self):
+        return self._named(READ_LOCK_NAME)
+
+    @property
+    def writers(self):
+        return self._named(WRITE_LOCK_NAME)
+
+    @property
+    def readers_waiting(self):
+        return self.count_waiting(READ_LOCK_NAME)
+
+    @property
+    def writers_waiting(self):
+        return self.count_waiting(WRITE_LOCK_NAME)
+
+
+def read_write_snapshot(index, owned=()):
+    # a writer only holds the lock from the front of the queue, readers hold
+    # it as long as no writer is queued ahead of them
+    participants = list(index)
+    writer = index.first(WRITE_LOCK_NAME)
+    if writer is None:
+        return ReadWriteSnapshot(participants, [], owned)
+
+    holders = index.position(writer.node) or 1
+    return ReadWriteSnapshot(
+        participants[:holders],
+        participants[holders:],
+        owned
+    )
+
+
+def read_write_snapshots(client, paths, concurrency=100):
+    # Snapshots of many read write locks, listing each directory once with
+    # pipelined requests (see fetch_children). Yields (path, snapshot) pairs
+    # as they arrive, in the order given.
+    driver = _LockDriver()
+
+    for path, children in fetch_children(client, paths, concurrency):
+        index = driver.create_index(READ_LOCK_NAME, children or ())
+        yield (path, read_write_snapshot(index))
+
+
+def _read_is_acquirable_in(index, sequence_node_name):
+    # same answer as _read_is_acquirable, but from the index's writer keys
+    if sequence_node_name not in index:
+        raise NoNodeError
+
+    writer = index.first(WRITE_LOCK_NAME, before=sequence_node_name)
+    if writer is None:
+        return (None, True)
+
+    return (writer.node, False)
+
+
+def _read_is_acquirable(children, sequence_node_name):
+    index = 0
+    write_index = maxsize
+    our_index = -1
 
-        for node in children:
-            if WRITE_LOCK_NAME in node:
-                write_index = min(index, write_index)
-            elif node.startswith(sequence_node_name):
-                our_index = index
-                break
+    for node in children:
+        if WRITE_LOCK_NAME in node:
+            write_index = min(index, write_index)
+        elif node.startswith(sequence_node_name):
+            our_index = index
+            break
 
-            index += 1
+        index += 1
 
-        if our_index < 0:
-            raise NoNodeError
+    if our_index < 0:
+        raise NoNodeError
 
-        acquirable = our_index < write_index
-        path = None if acquirable else children[write_index]
-        return (path, acquirable)
+    acquirable = our_index < write_index
+    path = None if acquirable else children[write_index]
+    return (path, acquirable)
@@ -0,0 +1,214 @@
+import logging
+from kazoo.exceptions import (
+    BadVersionError,
+    LockTimeout,
+    NoNodeError,
+    NotEmptyError
+)
+from threading import Event, Thread
+from time import time
+from .mutex import Mutex
+from .participants import _GUID_PREFIX
+from .utils import make_path
+
+log = logging.getLogger(__name__)
+
+
+def _after(rel, cursor):
+    # whether rel comes after cursor in a post-order walk, where children
+    # are visited (in sorted order) before their parent
+    if cursor is None:
+        return True
+
+    if rel == cursor:
+        return False
+
+    if cursor[:len(rel)] == rel:
+        return True  # an ancestor of the cursor
+
+    if rel[:len(cursor)] == cursor:
+        return False  # a descendant of the cursor
+
+    return rel > cursor
+
+
+class Reaper(object):
+    # Walks everything under `root` and deletes what locks leave behind:
+    # lock directories that have had children but are now empty, and
+    # protected (_c_ prefixed) nodes that aren't ephemeral, so no session can
+    # own them. Ephemeral nodes are left alone; the server removes them with
+    # their session.
+    #
+    # Each run visits at most `batch_size` nodes and remembers where it got
+    # to, and `rate` caps ZooKeeper calls per second. With `state_path`, the
+    # position is kept in ZooKeeper and runs are serialized by a mutex below
+    # it, so several reaper processes share one walk (and a restarted one
+    # picks up where the last one stopped).
+    #
+    #   reaper = Reaper(client, "/locks", state_path="/reapers/locks")
+    #   reaper.start()
+    def __init__(self, client, root, interval=60, batch_size=100, rate=50,
+                 state_path=None):
+        self._batch_size = batch_size
+        self._client = client
+        self._cursor = None
+        self._interval = interval
+        self._next_call = 0
+        self._rate = rate
+        self._removed = {}
+        self._root = root.rstrip("/") or "/"
+        self._state_path = state_path
+        self._stopped = Event()
+        self._thread = None
+
+        self._mutex = None
+        if state_path is not None:
+            self._mutex = Mutex(
+                client,
+                make_path(state_path, "lock"),
+                timeout=interval
+            )
+
+    @property
+    def root(self):
+        return self._root
+
+    @property
+    def cursor(self):
+        return self._cursor
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        # reaps one batch and returns the number of nodes deleted
+        if self._mutex is None:
+            return self._reap_batch()
+
+        # the state node has to be a regular node, and the mutex gets its own
+        # directory below it, since that's deleted whenever the mutex is
+        # released (as a container, or by clean() on older servers)
+        self._client.ensure_path(self._state_path)
+
+        try:
+            if not self._mutex.acquire():
+                return 0
+        except LockTimeout:
+            return 0  # another reaper is busy
+
+        try:
+            data, _ = self._client.get(self._state_path)
+            self._cursor = self._decode(data)
+
+            deleted = self._reap_batch()
+            self._client.set(self._state_path, self._encode(self._cursor))
+        finally:
+            self._mutex.release()
+
+        return deleted
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                # try again next time round
+                log.exception("Failed to reap %s", self._root)
+
+            self._stopped.wait(self._interval)
+
+    def _reap_batch(self):
+        deleted = 0
+        visited = 0
+        self._removed = {}
+
+        for path, rel, stat, empty in self._walk(self._root, (), None):
+            if visited >= self._batch_size or self._stopped.is_set():
+                return deleted
+
+            visited += 1
+            self._cursor = rel
+
+            if self._reap(path, rel, stat, empty):
+                deleted += 1
+
+        # made it all the way round, start over next time
+        self._cursor = None
+        return deleted
+
+    def _walk(self, path, rel, stat):
+        cursor = self._cursor
+
+        if stat is None:
+            stat = self._call(self._client.exists, path)
+            if stat is None:
+                return
+
+        children = []
+        if stat.numChildren:
+            try:
+                children = sorted(
+                    self._call(self._client.get_children, path)
+                )
+            except NoNodeError:
+                return
+
+        for child in children:
+            child_rel = rel + (child,)
+            child_path = make_path(path, child)
+
+            if child_path == self._state_path:
+                continue
+
+            if cursor is not None and child_rel < cursor[:len(child_rel)]:
+                continue  # everything in there was done by an earlier batch
+
+            for item in self._walk(child_path, child_rel, None):
+                yield item
+
+        if rel and _after(rel, cursor):
+            empty = len(children) <= self._removed.get(path, 0)
+            yield (path, rel, stat, empty)
+
+    def _reap(self, path, rel, stat, empty):
+        if stat.ephemeralOwner or not empty:
+            return False
+
+        if not rel[-1].startswith(_GUID_PREFIX) and not stat.cversion:
+            return False  # a directory nothing has been locked in yet
+
+        try:
+            self._call(self._client.delete, path, stat.version)
+        except (BadVersionError, NoNodeError, NotEmptyError):
+            return False  # in use again
+
+        parent = path.rsplit("/", 1)[0] or "/"
+        self._removed[parent] = self._removed.get(parent, 0) + 1
+        return True
+
+    def _call(self, fn, *args):
+        if self._rate:
+            now = time()
+            if self._next_call > now:
+                self._stopped.wait(self._next_call - now)
+
+            self._next_call = max(now, self._next_call) + 1.0 / self._rate
+
+        return fn(*args)
+
+    def _decode(self, data):
+        data = data.decode("utf-8")
+        return tuple(data.split("/")) if data else None
+
+    def _encode(self, cursor):
+        return "/".join(cursor or ()).encode("utf-8")
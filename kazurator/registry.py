@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from threading import Lock as ThreadLock
+from weakref import WeakValueDictionary
+from .mutex import Mutex
+from .read_write_lock import ReadWriteLock
+from .utils import mutex
+
+
+class LockRegistry(object):
+    # Hands out one lock instance per (client, path, type), so code that
+    # locks the same path over and over (a request handler, say) reuses the
+    # lock's state and stays reentrant across calls instead of building a new
+    # instance each time.
+    #
+    # Up to `max_size` instances are kept, least recently used first out.
+    # Only idle ones are evicted, and an evicted instance that's still
+    # referenced somewhere is found again through a weak reference, so two
+    # live instances never exist for the same key. Keyword arguments are
+    # only used when an instance is created.
+    #
+    #   lock = registry.read_write_lock(client, "/entities/123", timeout=5)
+    def __init__(self, max_size=1024):
+        self._evicted = WeakValueDictionary()
+        self._evictions = 0
+        self._hits = 0
+        self._locks = OrderedDict()
+        self._max_size = max_size
+        self._misses = 0
+        self._sync_lock = ThreadLock()
+
+    def __len__(self):
+        with mutex(self._sync_lock):
+            return len(self._locks)
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def evictions(self):
+        return self._evictions
+
+    def get(self, client, path, lock_type=Mutex, **kwargs):
+        key = (client, lock_type, path)
+
+        with mutex(self._sync_lock):
+            lock = self._locks.pop(key, None)
+            if lock is None:
+                lock = self._evicted.pop(key, None)
+
+            if lock is None:
+                self._misses += 1
+                lock = lock_type(client, path, **kwargs)
+            else:
+                self._hits += 1
+
+            self._locks[key] = lock
+            evicted = self._evict(key)
+
+        for idle in evicted:
+            idle.unwatch()
+
+        return lock
+
+    def mutex(self, client, path, **kwargs):
+        return self.get(client, path, Mutex, **kwargs)
+
+    def read_write_lock(self, client, path, **kwargs):
+        return self.get(client, path, ReadWriteLock, **kwargs)
+
+    def clear(self):
+        with mutex(self._sync_lock):
+            locks = list(self._locks.values())
+            self._evicted.update(self._locks)
+            self._locks.clear()
+
+        for lock in locks:
+            lock.unwatch()
+
+    def _evict(self, keep):
+        evicted = []
+        excess = len(self._locks) - self._max_size
+
+        for key, lock in list(self._locks.items()):
+            if excess <= 0:
+                break
+
+            if key == keep or lock.is_acquired:
+                continue  # held locks stay put, even over the limit
+
+            del self._locks[key]
+            self._evicted[key] = lock
+            evicted.append(lock)
+            excess -= 1
+
+        self._evictions += len(evicted)
+        return evicted
+
+
+# shared by everything in the process
+registry = LockRegistry()
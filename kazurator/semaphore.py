@@ -0,0 +1,309 @@
+import struct
+from kazoo.exceptions import (
+    LockTimeout,
+    NodeExistsError,
+    NoNodeError,
+    ZookeeperError
+)
+from kazoo.protocol.states import KazooState
+from time import time
+from .internals import Lock, LockDriver
+from .mutex import DEFAULT_LOCK_NAME
+from .utils import make_path, mutex
+
+LEASE_NAME = "lease-"
+LEASES_NODE = "leases"
+LOCKS_NODE = "locks"
+
+
+def _decode_count(data):
+    # curator's SharedCount stores a 4 byte, big endian int
+    return struct.unpack(">i", data[:4])[0]
+
+
+def _encode_count(value):
+    return struct.pack(">i", value)
+
+
+class Lease(object):
+    def __init__(self, semaphore, path):
+        self._path = path
+        self._semaphore = semaphore
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @property
+    def path(self):
+        return self._path
+
+    def release(self):
+        self._semaphore.release(self)
+
+
+class Semaphore(object):
+    _TIMEOUT_ERR = "Failed to acquire a lease on %s after %s seconds"
+
+    # A port of curator's InterProcessSemaphoreV2, using the same layout:
+    # lease nodes under <path>/leases, guarded by a mutex in <path>/locks.
+    #
+    # With `count_path`, the number of leases lives in a shared count node
+    # (curator's SharedCount) instead of being fixed by each process, and
+    # `max_leases` only seeds it. Waiters watch both the count and the lease
+    # directory, so raising the limit lets them in straight away.
+    #
+    #   with Semaphore(client, "/some/path", count_path="/some/count") \
+    #           .acquire():
+    #       ...
+    def __init__(self, client, path, max_leases=1, count_path=None,
+                 timeout=None):
+        self._client = client
+        self._count = None
+        self._count_path = count_path
+        self._driver = LockDriver()
+        self._held = set()
+        self._leases_path = make_path(path, LEASES_NODE)
+        self._max_leases = max_leases
+        self._path = path
+        self._sync_lock = client.handler.lock_object()
+        self._timeout = timeout
+        self._users = 0
+        self._waiters = set()
+
+        self._lock = Lock(
+            client,
+            LockDriver(),
+            make_path(path, LOCKS_NODE),
+            DEFAULT_LOCK_NAME,
+            1
+        )
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def count_path(self):
+        return self._count_path
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+
+    @property
+    def max_leases(self):
+        if self._count_path is None:
+            return self._max_leases
+
+        with mutex(self._sync_lock):
+            count = self._count
+
+        if count is None:
+            count = self._read_count()
+
+        return count
+
+    @max_leases.setter
+    def max_leases(self, value):
+        if self._count_path is None:
+            self._max_leases = value
+            self._wake()
+            return
+
+        data = _encode_count(value)
+
+        try:
+            self._client.set(self._count_path, data)
+        except NoNodeError:
+            self._client.create(self._count_path, data, makepath=True)
+
+    def get_participant_nodes(self):
+        try:
+            children = self._client.get_children(self._leases_path)
+        except NoNodeError:
+            return []
+
+        return [make_path(self._leases_path, child) for child in children]
+
+    def acquire(self):
+        timeout = self._timeout
+        deadline = None if timeout is None else time() + timeout
+
+        self._retain()
+        leased = False
+
+        try:
+            path = self._acquire(timeout, deadline)
+            leased = path is not None
+        finally:
+            if not leased:
+                self._relinquish()
+
+        if not leased:
+            # callers use the lease as a context manager, so there's no
+            # sensible value to return instead
+            raise LockTimeout(self._TIMEOUT_ERR % (self._path, timeout))
+
+        with mutex(self._sync_lock):
+            self._held.add(path)
+
+        return Lease(self, path)
+
+    def release(self, lease):
+        self._delete(lease.path)
+
+        with mutex(self._sync_lock):
+            held = lease.path in self._held
+            self._held.discard(lease.path)
+
+        if held:
+            self._relinquish()
+
+    def _acquire(self, timeout, deadline):
+        lock_path = self._lock.attempt_lock(timeout)
+        if not lock_path:
+            return None
+
+        try:
+            path = self._driver.create_lock(
+                self._client,
+                make_path(self._leases_path, LEASE_NAME)
+            )
+
+            leased = False
+
+            try:
+                self._wait(path, deadline)
+                leased = True
+            finally:
+                if not leased:
+                    self._delete(path)
+        finally:
+            self._lock.release_lock(lock_path)
+
+        return path
+
+    def _retain(self):
+        # the cached count is only trusted (and the session only watched)
+        # while someone is acquiring or holding a lease
+        if self._count_path is None:
+            return
+
+        with mutex(self._sync_lock):
+            self._users += 1
+            first = self._users == 1
+
+        if first:
+            self._client.add_listener(self._listener)
+
+    def _relinquish(self):
+        if self._count_path is None:
+            return
+
+        with mutex(self._sync_lock):
+            self._users -= 1
+            last = self._users == 0
+
+            if last:
+                self._count = None
+
+        if last:
+            self._client.remove_listener(self._listener)
+
+    def _wait(self, path, deadline):
+        name = path[len(self._leases_path) + 1:]
+        event = self._client.handler.event_object()
+
+        def wake(*args):
+            event.set()
+
+        with mutex(self._sync_lock):
+            self._waiters.add(event)
+
+        try:
+            while True:
+                event.clear()
+
+                children = self._client.get_children(self._leases_path, wake)
+                if name not in children:
+                    raise NoNodeError()
+
+                if len(children) <= self.max_leases:
+                    return
+
+                if deadline is None:
+                    event.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining > 0:
+                        event.wait(remaining)
+
+                    if not event.is_set():
+                        raise LockTimeout(
+                            self._TIMEOUT_ERR % (self._path, self._timeout)
+                        )
+        finally:
+            with mutex(self._sync_lock):
+                self._waiters.discard(event)
+
+    def _read_count(self):
+        try:
+            data, _ = self._client.get(self._count_path, self._count_changed)
+        except NoNodeError:
+            try:
+                self._client.create(
+                    self._count_path,
+                    _encode_count(self._max_leases),
+                    makepath=True
+                )
+            except NodeExistsError:
+                pass
+
+            data, _ = self._client.get(self._count_path, self._count_changed)
+
+        count = _decode_count(data)
+
+        with mutex(self._sync_lock):
+            if self._users:
+                self._count = count
+
+        return count
+
+    def _count_changed(self, event):
+        with mutex(self._sync_lock):
+            self._count = None
+            if not self._users:
+                return  # read it again on next use
+
+        try:
+            self._read_count()
+        except ZookeeperError:
+            pass  # read again on next use
+        finally:
+            self._wake()
+
+    def _listener(self, state):
+        if state == KazooState.LOST:
+            # the count watch went with the session
+            with mutex(self._sync_lock):
+                self._count = None
+
+    def _wake(self):
+        with mutex(self._sync_lock):
+            waiters = list(self._waiters)
+
+        for event in waiters:
+            event.set()
+
+    def _delete(self, path):
+        try:
+            self._client.delete(path)
+        except NoNodeError:
+            pass
@@ -0,0 +1,134 @@
+import hashlib
+from bisect import bisect
+from collections import namedtuple, OrderedDict
+from threading import Lock as ThreadLock
+from .instrumentation import LockObserver
+from .mutex import Mutex
+from .read_write_lock import ReadWriteLock
+from .utils import mutex
+
+ShardLoad = namedtuple("ShardLoad", ["locks", "acquires", "calls"])
+
+
+def _hash(key):
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+    return int(digest[:16], 16)
+
+
+class _ShardCounts(object):
+    def __init__(self):
+        self.acquires = 0
+        self.calls = 0
+        self.lock = ThreadLock()
+        self.locks = 0
+
+    def load(self):
+        with mutex(self.lock):
+            return ShardLoad(self.locks, self.acquires, self.calls)
+
+
+class _ShardObserver(LockObserver):
+    # counts what goes to one shard, then passes everything on to the
+    # caller's observer (if any)
+    def __init__(self, counts, observer=None):
+        self._counts = counts
+        self._observer = observer
+
+    def acquire_started(self, path):
+        if self._observer is not None:
+            self._observer.acquire_started(path)
+
+    def acquire_finished(self, path, seconds, acquired):
+        if acquired:
+            with mutex(self._counts.lock):
+                self._counts.acquires += 1
+
+        if self._observer is not None:
+            self._observer.acquire_finished(path, seconds, acquired)
+
+    def woke_up(self, path):
+        if self._observer is not None:
+            self._observer.woke_up(path)
+
+    def timed_out(self, path, seconds):
+        if self._observer is not None:
+            self._observer.timed_out(path, seconds)
+
+    def released(self, path, held_seconds):
+        if self._observer is not None:
+            self._observer.released(path, held_seconds)
+
+    def zookeeper_call(self, path, operation, seconds):
+        with mutex(self._counts.lock):
+            self._counts.calls += 1
+
+        if self._observer is not None:
+            self._observer.zookeeper_call(path, operation, seconds)
+
+
+class ShardedLocks(object):
+    # Spreads lock paths over several ZooKeeper ensembles. Each path maps to
+    # one client on a consistent hash ring (with `replicas` points per
+    # shard), so every process agrees on where a lock lives, and adding a
+    # shard only moves the paths that land on its points. The locks handed
+    # out are ordinary Mutex and ReadWriteLock instances.
+    #
+    # Shards are named, and the names are what's hashed, so keep them stable
+    # (a list of clients is named by position).
+    #
+    #   locks = ShardedLocks({"a": client_a, "b": client_b})
+    #   with locks.mutex("/jobs/123"):
+    #       ...
+    def __init__(self, clients, replicas=100):
+        if not isinstance(clients, dict):
+            clients = OrderedDict(
+                (str(index), client) for index, client in enumerate(clients)
+            )
+
+        if not clients:
+            raise ValueError("At least one client is required")
+
+        self._clients = clients
+        self._counts = dict((name, _ShardCounts()) for name in clients)
+
+        ring = sorted(
+            (_hash("%s-%d" % (name, replica)), name)
+            for name in clients
+            for replica in range(replicas)
+        )
+
+        self._hashes = [point for point, _ in ring]
+        self._names = [name for _, name in ring]
+
+    @property
+    def shards(self):
+        return list(self._clients)
+
+    def shard_for(self, path):
+        index = bisect(self._hashes, _hash(path)) % len(self._hashes)
+        return self._names[index]
+
+    def client_for(self, path):
+        return self._clients[self.shard_for(path)]
+
+    def mutex(self, path, **kwargs):
+        return self._create(Mutex, path, kwargs)
+
+    def read_write_lock(self, path, **kwargs):
+        return self._create(ReadWriteLock, path, kwargs)
+
+    def load(self):
+        # per shard: locks handed out, acquisitions and ZooKeeper calls
+        return dict(
+            (name, counts.load()) for name, counts in self._counts.items()
+        )
+
+    def _create(self, lock_type, path, kwargs):
+        name = self.shard_for(path)
+        counts = self._counts[name]
+        kwargs["observer"] = _ShardObserver(counts, kwargs.get("observer"))
+
+        with mutex(counts.lock):
+            counts.locks += 1
+
+        return lock_type(self._clients[name], path, **kwargs)
@@ -0,0 +1,760 @@
+import time
+from collections import deque
+from copy import copy
+from threading import Condition, RLock, local
+from kazoo.exceptions import (
+    BadVersionError,
+    ConnectionClosedError,
+    ConnectionLoss,
+    NoChildrenForEphemeralsError,
+    NodeExistsError,
+    NoNodeError,
+    NotEmptyError,
+    RolledBackError,
+    RuntimeInconsistency,
+    UnimplementedError,
+    ZookeeperError
+)
+from kazoo.handlers.threading import SequentialThreadingHandler
+from kazoo.protocol.states import (
+    Callback,
+    EventType,
+    KazooState,
+    KeeperState,
+    WatchedEvent,
+    ZnodeStat
+)
+from .utils import mutex
+
+# An in-process stand-in for a ZooKeeper ensemble and the parts of
+# KazooClient that the lock recipes rely on. Every FakeClient attached to the
+# same FakeZooKeeper behaves like a separate process with its own session, so
+# contention, watches and ephemeral cleanup can be exercised without a server.
+#
+#   server = FakeZooKeeper()
+#   client = FakeClient(server, latency=0.002)
+#   client.start()
+
+
+_CREATE_CONTAINER = 19
+
+
+def _parent(path):
+    parent = path.rsplit("/", 1)[0]
+    return parent if parent else "/"
+
+
+def _basename(path):
+    return path.rsplit("/", 1)[-1]
+
+
+def _wrap_int32(value):
+    return (value + 2 ** 31) % 2 ** 32 - 2 ** 31
+
+
+class _Node(object):
+    def __init__(self, zxid, data=b"", ephemeral_owner=0, container=False):
+        self.children = {}
+        self.container = container
+        self.created = int(time.time() * 1000)
+        self.modified = self.created
+        self.czxid = zxid
+        self.mzxid = zxid
+        self.pzxid = zxid
+        self.cversion = 0
+        self.data = data
+        self.ephemeral_owner = ephemeral_owner
+        self.version = 0
+
+    def stat(self):
+        return ZnodeStat(
+            self.czxid,
+            self.mzxid,
+            self.created,
+            self.modified,
+            self.version,
+            self.cversion,
+            0,
+            self.ephemeral_owner,
+            len(self.data),
+            len(self.children),
+            self.pzxid
+        )
+
+
+class FakeZooKeeper(object):
+    # `containers=False` behaves like a server older than 3.5, which rejects
+    # container nodes. Like a real server, empty containers stick around
+    # until the next check, which here is a call to reap_containers.
+    def __init__(self, containers=True):
+        self.containers = containers
+        self._lock = RLock()
+        self._nodes = {"/": _Node(0)}
+        self._next_session_id = 1
+        self._sessions = {}
+        self._data_watches = {}
+        self._child_watches = {}
+        self._zxid = 0
+
+    @property
+    def sessions(self):
+        with mutex(self._lock):
+            return dict(self._sessions)
+
+    def node_count(self):
+        with mutex(self._lock):
+            return len(self._nodes)
+
+    def set_sequence(self, path, value):
+        with mutex(self._lock):
+            self._node(path).cversion = _wrap_int32(value)
+
+    def reap_containers(self):
+        # what the server's container manager does periodically: delete
+        # containers that have had children but are now empty
+        with mutex(self._lock):
+            triggers = []
+            reaped = True
+
+            while reaped:
+                reaped = [
+                    path for path, node in self._nodes.items()
+                    if node.container and node.cversion and not node.children
+                ]
+
+                for path in reaped:
+                    triggers.extend(self._remove(path))
+
+            events = self._collect(triggers)
+
+        self._fire(events)
+        return events
+
+    def open_session(self, client):
+        with mutex(self._lock):
+            session_id = self._next_session_id
+            self._next_session_id += 1
+            self._sessions[session_id] = client
+            return session_id
+
+    def close_session(self, session_id):
+        with mutex(self._lock):
+            client = self._sessions.pop(session_id, None)
+            triggers = []
+
+            owned = [
+                path for path, node in self._nodes.items()
+                if node.ephemeral_owner == session_id
+            ]
+
+            for path in owned:
+                triggers.extend(self._remove(path))
+
+            for watches in (self._data_watches, self._child_watches):
+                for path in list(watches):
+                    watches[path] = [
+                        (owner, fn) for owner, fn in watches[path]
+                        if owner is not client
+                    ]
+
+            events = self._collect(triggers)
+
+        self._fire(events)
+
+    def create(self, client, path, value=b"", ephemeral=False,
+               sequence=False, makepath=False):
+        return self._write(
+            self._create,
+            client,
+            path,
+            value,
+            ephemeral,
+            sequence,
+            makepath
+        )
+
+    def create_container(self, client, path):
+        if not self.containers:
+            raise UnimplementedError()
+
+        return self._write(self._create_container, client, path)
+
+    def delete(self, client, path, version=-1):
+        return self._write(self._delete, client, path, version)
+
+    def set(self, client, path, value, version=-1):
+        return self._write(self._set, client, path, value, version)
+
+    def multi(self, client, operations):
+        # operations are (name, args) pairs, e.g. ("create", (path, ...)),
+        # applied atomically the same way a real multi request is
+        with mutex(self._lock):
+            saved = {}
+            triggers = []
+            results = []
+            zxid = self._zxid
+
+            for name, args in operations:
+                path = args[0]
+                for affected in (path, _parent(path)):
+                    if affected not in saved:
+                        saved[affected] = self._copy(affected)
+
+                try:
+                    result, op_triggers = getattr(self, "_" + name)(
+                        client,
+                        *args
+                    )
+                except ZookeeperError as err:
+                    self._restore(saved)
+                    self._zxid = zxid
+
+                    failed = len(results)
+                    results = [RolledBackError() for _ in range(failed)]
+                    results.append(err)
+                    results.extend(
+                        RuntimeInconsistency()
+                        for _ in operations[failed + 1:]
+                    )
+
+                    return results
+
+                if name == "create" and result not in saved:
+                    saved[result] = None
+
+                results.append(result)
+                triggers.extend(op_triggers)
+
+            events = self._collect(triggers)
+
+        self._fire(events)
+        return results
+
+    def exists(self, client, path, watch=None):
+        with mutex(self._lock):
+            if watch:
+                self._watch(self._data_watches, path, client, watch)
+
+            node = self._nodes.get(path)
+            return node.stat() if node else None
+
+    def get(self, client, path, watch=None):
+        with mutex(self._lock):
+            node = self._node(path)
+
+            if watch:
+                self._watch(self._data_watches, path, client, watch)
+
+            return (node.data, node.stat())
+
+    def get_children(self, client, path, watch=None, include_data=False):
+        with mutex(self._lock):
+            node = self._node(path)
+
+            if watch:
+                self._watch(self._child_watches, path, client, watch)
+
+            if include_data:
+                return (list(node.children), node.stat())
+
+            return list(node.children)
+
+    def _write(self, fn, client, *args):
+        with mutex(self._lock):
+            result, triggers = fn(client, *args)
+            events = self._collect(triggers)
+
+        self._fire(events)
+        return result
+
+    def _create(self, client, path, value=b"", ephemeral=False,
+                sequence=False, makepath=False):
+        triggers = []
+        parent_path = _parent(path)
+
+        if parent_path not in self._nodes:
+            if not makepath:
+                raise NoNodeError(parent_path)
+
+            triggers.extend(self._ensure(parent_path))
+
+        parent = self._nodes[parent_path]
+        if parent.ephemeral_owner:
+            raise NoChildrenForEphemeralsError(parent_path)
+
+        if sequence:
+            path = "%s%010d" % (path, parent.cversion)
+
+        if path in self._nodes:
+            raise NodeExistsError(path)
+
+        owner = client.session_id if ephemeral else 0
+        triggers.extend(self._add(path, value, owner))
+        return (path, triggers)
+
+    def _create_container(self, client, path):
+        if _parent(path) not in self._nodes:
+            raise NoNodeError(_parent(path))
+
+        if path in self._nodes:
+            raise NodeExistsError(path)
+
+        triggers = self._add(path, b"", 0, container=True)
+        return ((path, self._nodes[path].stat()), triggers)
+
+    def _delete(self, client, path, version=-1):
+        node = self._node(path)
+
+        if version != -1 and node.version != version:
+            raise BadVersionError(path)
+
+        if node.children:
+            raise NotEmptyError(path)
+
+        return (True, self._remove(path))
+
+    def _set(self, client, path, value, version=-1):
+        node = self._node(path)
+
+        if version != -1 and node.version != version:
+            raise BadVersionError(path)
+
+        self._zxid += 1
+        node.data = value
+        node.version += 1
+        node.mzxid = self._zxid
+        node.modified = int(time.time() * 1000)
+
+        return (node.stat(), [(self._data_watches, path, EventType.CHANGED)])
+
+    def _check(self, client, path, version):
+        node = self._node(path)
+
+        if node.version != version:
+            raise BadVersionError(path)
+
+        return (True, [])
+
+    def _copy(self, path):
+        node = self._nodes.get(path)
+        if node is None:
+            return None
+
+        saved = copy(node)
+        saved.children = dict(node.children)
+        return saved
+
+    def _restore(self, saved):
+        for path, node in saved.items():
+            if node is None:
+                self._nodes.pop(path, None)
+            else:
+                self._nodes[path] = node
+
+    def _node(self, path):
+        node = self._nodes.get(path)
+        if node is None:
+            raise NoNodeError(path)
+
+        return node
+
+    def _ensure(self, path):
+        triggers = []
+        if path in self._nodes:
+            return triggers
+
+        triggers.extend(self._ensure(_parent(path)))
+        triggers.extend(self._add(path, b"", 0))
+        return triggers
+
+    def _add(self, path, value, owner, container=False):
+        self._zxid += 1
+        parent_path = _parent(path)
+        parent = self._nodes[parent_path]
+        parent.children[_basename(path)] = True
+        parent.cversion = _wrap_int32(parent.cversion + 1)
+        parent.pzxid = self._zxid
+
+        self._nodes[path] = _Node(self._zxid, value, owner, container)
+
+        return [
+            (self._data_watches, path, EventType.CREATED),
+            (self._child_watches, parent_path, EventType.CHILD)
+        ]
+
+    def _remove(self, path):
+        self._zxid += 1
+        parent_path = _parent(path)
+        parent = self._nodes[parent_path]
+        parent.children.pop(_basename(path), None)
+        parent.cversion = _wrap_int32(parent.cversion + 1)
+        parent.pzxid = self._zxid
+
+        del self._nodes[path]
+
+        return [
+            (self._data_watches, path, EventType.DELETED),
+            (self._child_watches, path, EventType.DELETED),
+            (self._child_watches, parent_path, EventType.CHILD)
+        ]
+
+    def _watch(self, watches, path, client, fn):
+        # like kazoo, the same function only gets one notification
+        registered = watches.setdefault(path, [])
+        if (client, fn) not in registered:
+            registered.append((client, fn))
+
+    def _collect(self, triggers):
+        events = []
+
+        for watches, path, event_type in triggers:
+            event = WatchedEvent(event_type, KeeperState.CONNECTED, path)
+            events.extend(
+                (client, fn, event) for client, fn in watches.pop(path, [])
+            )
+
+        return events
+
+    def _fire(self, events):
+        for client, fn, event in events:
+            client.handler.dispatch_callback(Callback("watch", fn, (event,)))
+
+
+class _FakeTransaction(object):
+    def __init__(self, client):
+        self.client = client
+        self.committed = False
+        self.operations = []
+
+    def create(self, path, value=b"", acl=None, ephemeral=False,
+               sequence=False):
+        self.operations.append(
+            ("create", (path, value, ephemeral, sequence, False))
+        )
+
+    def delete(self, path, version=-1):
+        self.operations.append(("delete", (path, version)))
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(("set", (path, value, version)))
+
+    def check(self, path, version):
+        self.operations.append(("check", (path, version)))
+
+    def commit(self):
+        self.committed = True
+        return self.client._operation(
+            "transaction",
+            self.client.server.multi,
+            self.operations
+        )
+
+    def commit_async(self):
+        return self.client._async(self.commit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not exc_type:
+            self.commit()
+
+
+class FakeClient(object):
+    def __init__(self, server=None, handler=None, latency=0):
+        self._applied = 0
+        self._failures = deque()
+        self._issued = 0
+        self._lock = RLock()
+        self._order = Condition()
+        self._session_id = None
+        self._ticket = local()
+        self.chroot = ""
+        self.default_acl = None
+        self.handler = handler or SequentialThreadingHandler()
+        self.latency = latency
+        self.server = server or FakeZooKeeper()
+        self.state = KazooState.LOST
+        self.state_listeners = set()
+
+    @property
+    def client_id(self):
+        if self.connected:
+            return (self._session_id, b"")
+
+        return None
+
+    @property
+    def connected(self):
+        return self.state == KazooState.CONNECTED
+
+    @property
+    def session_id(self):
+        return self._session_id
+
+    def start(self, timeout=15):
+        self.handler.start()
+
+        with mutex(self._lock):
+            if self._session_id is None:
+                self._session_id = self.server.open_session(self)
+
+        self._make_state_change(KazooState.CONNECTED)
+
+    def stop(self):
+        with mutex(self._lock):
+            session_id, self._session_id = self._session_id, None
+
+        if session_id is not None:
+            self.server.close_session(session_id)
+
+        self._make_state_change(KazooState.LOST)
+        self.handler.stop()
+
+    def close(self):
+        pass
+
+    def add_listener(self, listener):
+        self.state_listeners.add(listener)
+
+    def remove_listener(self, listener):
+        self.state_listeners.discard(listener)
+
+    def suspend(self):
+        self._make_state_change(KazooState.SUSPENDED)
+
+    def resume(self):
+        self._make_state_change(KazooState.CONNECTED)
+
+    def expire_session(self):
+        with mutex(self._lock):
+            session_id = self._session_id
+            self._session_id = self.server.open_session(self)
+
+        self.server.close_session(session_id)
+        self._make_state_change(KazooState.LOST)
+        self._make_state_change(KazooState.CONNECTED)
+
+    def inject_failure(self, operation, error=ConnectionLoss, applied=False):
+        # Queue up a failure for the next call to `operation`. When `applied`
+        # is set, the request reaches the server before the error is raised,
+        # the same as a response lost on the wire.
+        with mutex(self._lock):
+            self._failures.append((operation, error, applied))
+
+    def create(self, path, value=b"", acl=None, ephemeral=False,
+               sequence=False, makepath=False):
+        return self._operation(
+            "create",
+            self.server.create,
+            path,
+            value,
+            ephemeral,
+            sequence,
+            makepath
+        )
+
+    def ensure_path(self, path, acl=None):
+        return self._operation("ensure_path", self._ensure_path, path)
+
+    def delete(self, path, version=-1, recursive=False):
+        if recursive:
+            return self._delete_recursive(path)
+
+        return self._operation("delete", self.server.delete, path, version)
+
+    def exists(self, path, watch=None):
+        return self._operation("exists", self.server.exists, path, watch)
+
+    def get(self, path, watch=None):
+        return self._operation("get", self.server.get, path, watch)
+
+    def get_children(self, path, watch=None, include_data=False):
+        return self._operation(
+            "get_children",
+            self.server.get_children,
+            path,
+            watch,
+            include_data
+        )
+
+    def set(self, path, value, version=-1):
+        return self._operation("set", self.server.set, path, value, version)
+
+    def transaction(self):
+        return _FakeTransaction(self)
+
+    def create_async(self, path, value=b"", acl=None, ephemeral=False,
+                     sequence=False, makepath=False):
+        return self._async(
+            self.create,
+            path,
+            value,
+            acl,
+            ephemeral,
+            sequence,
+            makepath
+        )
+
+    def delete_async(self, path, version=-1):
+        return self._async(self.delete, path, version)
+
+    def exists_async(self, path, watch=None):
+        return self._async(self.exists, path, watch)
+
+    def get_async(self, path, watch=None):
+        return self._async(self.get, path, watch)
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        return self._async(self.get_children, path, watch, include_data)
+
+    def set_async(self, path, value, version=-1):
+        return self._async(self.set, path, value, version)
+
+    def _call(self, request, async_object):
+        # raw requests, which is how kazurator creates container nodes
+        def run():
+            if request.type != _CREATE_CONTAINER:
+                raise NotImplementedError(request)
+
+            return self._operation(
+                "create_container",
+                self.server.create_container,
+                request.path
+            )
+
+        try:
+            async_object.set(run())
+        except Exception as err:
+            async_object.set_exception(err)
+
+        return True
+
+    def _operation(self, operation, fn, *args):
+        ticket = getattr(self._ticket, "value", None)
+        self._ticket.value = None
+
+        self._round_trip()
+
+        if ticket is None:
+            return self._apply(operation, fn, *args)
+
+        try:
+            self._wait_for_turn(ticket)
+            return self._apply(operation, fn, *args)
+        finally:
+            self._take_turn(ticket)
+
+    def _apply(self, operation, fn, *args):
+        if self.state == KazooState.SUSPENDED:
+            raise ConnectionLoss()
+
+        if self._session_id is None or self.state != KazooState.CONNECTED:
+            raise ConnectionClosedError("Connection has been closed")
+
+        failure = self._next_failure(operation)
+        if failure is None:
+            return fn(self, *args)
+
+        error, applied = failure
+        if applied:
+            fn(self, *args)
+
+        raise error()
+
+    def _async(self, fn, *args):
+        async_result = self.handler.async_result()
+        delayed = self._delay()
+
+        if delayed:
+            # ZooKeeper applies a session's requests in the order they were
+            # sent, so pipelined requests have to reach the server in order
+            with self._order:
+                ticket = self._issued
+                self._issued += 1
+
+        def run():
+            if delayed:
+                self._ticket.value = ticket
+
+            try:
+                async_result.set(fn(*args))
+            except Exception as err:
+                async_result.set_exception(err)
+            finally:
+                if delayed and self._ticket.value is not None:
+                    # never got as far as the server
+                    self._ticket.value = None
+                    self._wait_for_turn(ticket)
+                    self._take_turn(ticket)
+
+        if delayed:
+            self.handler.spawn(run)
+        else:
+            run()
+
+        return async_result
+
+    def _wait_for_turn(self, ticket):
+        with self._order:
+            while self._applied != ticket:
+                self._order.wait()
+
+    def _take_turn(self, ticket):
+        with self._order:
+            self._applied = ticket + 1
+            self._order.notify_all()
+
+    def _next_failure(self, operation):
+        with mutex(self._lock):
+            for failure in self._failures:
+                if failure[0] == operation:
+                    self._failures.remove(failure)
+                    return failure[1:]
+
+        return None
+
+    def _delay(self):
+        return self.latency() if callable(self.latency) else self.latency
+
+    def _round_trip(self):
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+
+    def _ensure_path(self, _client, path):
+        if path == "/":
+            return True
+
+        try:
+            self.server.create(self, path, makepath=True)
+        except NodeExistsError:
+            pass
+
+        return True
+
+    def _delete_recursive(self, path):
+        try:
+            children = self.get_children(path)
+        except NoNodeError:
+            return True
+
+        for child in children:
+            self._delete_recursive(path.rstrip("/") + "/" + child)
+
+        try:
+            self.delete(path)
+        except NoNodeError:
+            pass
+
+        return True
+
+    def _make_state_change(self, state):
+        if self.state == state:
+            return
+
+        self.state = state
+
+        for listener in list(self.state_listeners):
+            if listener(state) is True:
+                self.remove_listener(listener)
@@ -1,12 +1,41 @@
+import os
+import time
 from contextlib import contextmanager
 from kazoo.client import KazooClient
+from kazurator.testing import FakeClient, FakeZooKeeper
+
+# Set KAZURATOR_FAKE_ZK=1 to run the suite against an in-process fake instead
+# of the ZooKeeper container started by script/test.
+_FAKE_SERVER = FakeZooKeeper() if os.environ.get("KAZURATOR_FAKE_ZK") else None
 
 
 @contextmanager
 def kazoo_client():
     try:
-        client = KazooClient(hosts="127.0.0.1:2181")
+        if _FAKE_SERVER:
+            client = FakeClient(_FAKE_SERVER)
+        else:
+            client = KazooClient(hosts="127.0.0.1:2181")
+
         client.start()
         yield client
     finally:
         client.stop()
+
+
+@contextmanager
+def fake_client(server=None, **kwargs):
+    client = FakeClient(server or FakeZooKeeper(), **kwargs)
+
+    try:
+        client.start()
+        yield client
+    finally:
+        client.stop()
+
+
+def wait_for_children(client, path, count):
+    # polls until path has at least count children; lock directories don't
+    # exist until the first node goes in
+    while not client.exists(path) or len(client.get_children(path)) < count:
+        time.sleep(0.01)
@@ -0,0 +1,215 @@
+import asyncio
+from kazoo.exceptions import LockTimeout
+from kazurator import Mutex, ReadWriteLock
+from kazurator.aio import AsyncMutex, AsyncReadWriteLock
+from kazurator.testing import FakeZooKeeper
+from threading import Thread, ThreadError
+from time import time
+from unittest import TestCase
+from . import fake_client, wait_for_children
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAsyncMutex(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_path"
+
+    def test_acquire_and_release(self):
+        async def scenario(client):
+            mutex = AsyncMutex(client, self.path, timeout=0.5)
+
+            async with mutex:
+                assert mutex.is_acquired
+                assert mutex.is_owned_by_current_task
+                assert len(await mutex.get_participant_nodes()) == 1
+
+            assert not mutex.is_acquired
+            assert client.get_children(self.path) == []
+
+        with fake_client(self.server) as client:
+            _run(scenario(client))
+
+    def test_acquire_is_reentrant_per_task(self):
+        async def scenario(client):
+            mutex = AsyncMutex(client, self.path, timeout=0.5)
+
+            async with mutex:
+                assert await mutex.acquire_async()
+                await mutex.release_async()
+                assert len(client.get_children(self.path)) == 1
+
+        with fake_client(self.server) as client:
+            _run(scenario(client))
+
+    def test_waiters_are_serialized_without_threads(self):
+        held = []
+        overlaps = []
+
+        async def worker(mutex):
+            async with mutex:
+                if held:
+                    overlaps.append(mutex)
+
+                held.append(mutex)
+                await asyncio.sleep(0.001)
+                held.remove(mutex)
+
+        async def scenario(client):
+            mutexes = [
+                AsyncMutex(client, self.path, timeout=5) for _ in range(50)
+            ]
+
+            await asyncio.gather(*[worker(m) for m in mutexes])
+
+        with fake_client(self.server) as client:
+            _run(scenario(client))
+            assert overlaps == []
+            assert client.get_children(self.path) == []
+
+    def test_acquire_times_out_when_held_by_sync_mutex(self):
+        with fake_client(self.server) as client:
+            with Mutex(client, self.path):
+                mutex = AsyncMutex(client, self.path, timeout=0.2)
+
+                with self.assertRaises(LockTimeout):
+                    _run(mutex.acquire_async())
+
+                assert len(client.get_children(self.path)) == 1
+
+    def test_timeout_covers_every_wakeup(self):
+        with fake_client(self.server) as client:
+            with Mutex(client, self.path):
+                queued = Mutex(client, self.path, timeout=0.3)
+
+                def wait_behind_queued():
+                    with self.assertRaises(LockTimeout):
+                        queued.acquire()
+
+                thread = Thread(target=wait_behind_queued)
+                thread.start()
+
+                wait_for_children(client, self.path, 2)
+
+                # wakes up when the queued node times out, then has to
+                # wait out the rest of its timeout behind the holder
+                mutex = AsyncMutex(client, self.path, timeout=0.5)
+                start = time()
+
+                with self.assertRaises(LockTimeout):
+                    _run(mutex.acquire_async())
+
+                thread.join()
+                assert time() - start < 0.7
+
+    def test_lock_directories_are_containers(self):
+        async def scenario(client):
+            async with AsyncMutex(client, self.path, timeout=0.5):
+                pass
+
+        with fake_client(self.server) as client:
+            _run(scenario(client))
+            self.server.reap_containers()
+
+            assert not client.exists("/haderp")
+
+    def test_recovers_its_node_after_a_lost_create_response(self):
+        async def scenario(client):
+            client.ensure_path(self.path)
+            client.inject_failure("create", applied=True)
+
+            mutex = AsyncMutex(client, self.path, timeout=0.5)
+            async with mutex:
+                assert len(client.get_children(self.path)) == 1
+
+        with fake_client(self.server) as client:
+            _run(scenario(client))
+            assert client.get_children(self.path) == []
+
+    def test_cancelled_waiter_removes_its_node(self):
+        async def scenario(client):
+            task = asyncio.ensure_future(
+                AsyncMutex(client, self.path).acquire_async()
+            )
+
+            await asyncio.sleep(0.05)
+            assert len(client.get_children(self.path)) == 2
+
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+            await asyncio.sleep(0.05)
+
+        with fake_client(self.server) as client:
+            with Mutex(client, self.path):
+                _run(scenario(client))
+                assert len(client.get_children(self.path)) == 1
+
+    def test_cancelled_create_removes_its_node(self):
+        async def scenario(client):
+            mutex = AsyncMutex(client, self.path)
+
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(mutex.acquire_async(), 0.01)
+
+            await asyncio.sleep(0.2)
+
+        with fake_client(self.server, latency=0.05) as client:
+            client.ensure_path(self.path)
+            _run(scenario(client))
+            assert client.get_children(self.path) == []
+
+    def test_release_raises_thread_error_when_lock_not_acquired(self):
+        with fake_client(self.server) as client:
+            mutex = AsyncMutex(client, self.path)
+
+            with self.assertRaises(ThreadError):
+                _run(mutex.release_async())
+
+
+class TestAsyncReadWriteLock(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_path"
+
+    def test_readers_share_the_lock(self):
+        async def scenario(client):
+            first = AsyncReadWriteLock(client, self.path, 0.5)
+            second = AsyncReadWriteLock(client, self.path, 0.5)
+
+            async with first.read_lock:
+                async with second.read_lock:
+                    nodes = await first.get_participant_nodes()
+                    assert len(nodes) == 2
+
+        with fake_client(self.server) as client:
+            _run(scenario(client))
+
+    def test_read_lock_blocks_when_sync_write_lock_held(self):
+        with fake_client(self.server) as client:
+            writer = ReadWriteLock(client, self.path)
+            reader = AsyncReadWriteLock(client, self.path, 0.2)
+
+            with writer.write_lock:
+                with self.assertRaises(LockTimeout):
+                    _run(reader.read_lock.acquire_async())
+
+    def test_write_lock_holder_can_take_read_lock(self):
+        async def scenario(client):
+            lock = AsyncReadWriteLock(client, self.path, 0.2)
+
+            async with lock.write_lock:
+                async with lock.read_lock:
+                    assert len(client.get_children(self.path)) == 2
+
+        with fake_client(self.server) as client:
+            _run(scenario(client))
@@ -0,0 +1,6 @@
+import sys
+
+# the asyncio recipes (and their tests) use async/await, which older pythons
+# can't even parse
+if sys.version_info >= (3, 5):
+    from .aio_cases import TestAsyncMutex, TestAsyncReadWriteLock  # noqa
@@ -0,0 +1,106 @@
+from kazoo.exceptions import LockTimeout
+from kazurator import Mutex, ReadWriteLock
+from kazurator.instrumentation import LockObserver
+from kazurator.testing import FakeZooKeeper
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+from . import fake_client
+
+
+class _RecordingObserver(LockObserver):
+    def __init__(self):
+        self.events = []
+
+    def acquire_started(self, path):
+        self.events.append(("acquire_started", path))
+
+    def acquire_finished(self, path, seconds, acquired):
+        self.events.append(("acquire_finished", path, acquired))
+
+    def woke_up(self, path):
+        self.events.append(("woke_up", path))
+
+    def timed_out(self, path, seconds):
+        self.events.append(("timed_out", path))
+
+    def released(self, path, held_seconds):
+        self.events.append(("released", path, held_seconds))
+
+    def zookeeper_call(self, path, operation, seconds):
+        self.events.append(("zookeeper_call", path, operation))
+
+    def names(self):
+        return [event[0] for event in self.events]
+
+    def operations(self):
+        return [e[2] for e in self.events if e[0] == "zookeeper_call"]
+
+
+class TestLockObserver(TestCase):
+    def setUp(self):
+        self.observer = _RecordingObserver()
+        self.path = "/haderp/some_path"
+        self.server = FakeZooKeeper()
+
+    def test_uncontended_acquire_and_release(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path, observer=self.observer)
+
+            with mutex:
+                sleep(0.01)
+
+        lock_path = self.path + "/lock-"
+        assert self.observer.events[0] == ("acquire_started", lock_path)
+        assert self.observer.names()[-1] == "released"
+        assert self.observer.events[-1][2] >= 0.01
+        assert ("acquire_finished", lock_path, True) in self.observer.events
+        assert self.observer.operations() == [
+            "create",
+            "get_children",
+            "delete"
+        ]
+
+    def test_wakeups_are_reported(self):
+        with fake_client(self.server) as client:
+            holder = Mutex(client, self.path)
+            holder.acquire()
+
+            mutex = Mutex(client, self.path, timeout=1, observer=self.observer)
+            thread = Thread(target=mutex.acquire)
+            thread.start()
+
+            while "exists" not in self.observer.operations():
+                sleep(0.01)
+
+            holder.release()
+            thread.join()
+
+        assert "woke_up" in self.observer.names()
+        assert ("acquire_finished", self.path + "/lock-", True) in \
+            self.observer.events
+
+    def test_timeouts_are_reported(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 0.1)
+            lock.write_lock.acquire()
+
+            observed = ReadWriteLock(
+                client,
+                self.path,
+                0.1,
+                observer=self.observer
+            )
+
+            with self.assertRaises(LockTimeout):
+                observed.read_lock.acquire()
+
+        read_path = self.path + "/__READ__"
+        assert ("timed_out", read_path) in self.observer.events
+        assert ("acquire_finished", read_path, False) in self.observer.events
+        assert "released" not in self.observer.names()
+
+    def test_base_observer_ignores_everything(self):
+        with fake_client(self.server) as client:
+            with Mutex(client, self.path, observer=LockObserver()):
+                pass
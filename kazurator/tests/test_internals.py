@@ -1,9 +1,20 @@
+import time
 from contextlib import contextmanager
-from kazoo.exceptions import LockTimeout, NoNodeError
-from kazurator.internals import Lock, LockDriver
+from kazoo.exceptions import (
+    CancelledError,
+    ConnectionLoss,
+    LockTimeout,
+    NoNodeError
+)
+from kazoo.retry import ForceRetryError, KazooRetry, RetryFailedError
+from kazurator.internals import Lock, LockDriver, supports_containers
+from kazurator.mutex import Mutex
+from kazurator.participants import ParticipantIndex, parse
+from kazurator.testing import FakeZooKeeper
 from kazurator.utils import make_path
+from threading import Event, Thread
 from unittest import TestCase
-from . import kazoo_client
+from . import fake_client, kazoo_client, wait_for_children
 
 
 class TestLock(TestCase):
@@ -149,3 +160,428 @@ class TestLockDriver(TestCase):
 
     def test_sort_key_returns_original_string_when_name_not_found(self):
         assert self.driver.sort_key("/some/path", "__READ__") == "/some/path"
+
+    def test_is_acquirable_in_uses_the_index(self):
+        index = self.driver.create_index("lock-", [
+            "_c_9d1b3f0e-2f51-4c1a-9f55-4b0b1c1e2d3f-lock-0000000002",
+            "lock-0000000001",
+            "lock-0000000003"
+        ])
+
+        path, acquirable = self.driver.is_acquirable_in(
+            index,
+            "lock-0000000003",
+            1
+        )
+
+        assert not acquirable
+        assert path.endswith("-lock-0000000002")
+
+        path, acquirable = self.driver.is_acquirable_in(
+            index,
+            "lock-0000000001",
+            1
+        )
+
+        assert acquirable
+        assert path is None
+
+    def test_is_acquirable_in_raises_when_node_not_found(self):
+        index = self.driver.create_index("lock-", ["lock-0000000001"])
+
+        with self.assertRaises(NoNodeError):
+            self.driver.is_acquirable_in(index, "lock-0000000002", 1)
+
+
+class _CountingDriver(LockDriver):
+    def __init__(self):
+        super(_CountingDriver, self).__init__()
+        self.keys = 0
+
+    def create_index(self, lock_name, nodes=()):
+        def counting_parse(node, lock_names):
+            self.keys += 1
+            return parse(node, lock_names)
+
+        return ParticipantIndex(self.lock_names(lock_name), nodes,
+                                counting_parse)
+
+
+class TestChildrenCache(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_lock_path"
+
+    def test_view_is_sorted_and_follows_changes(self):
+        driver = _CountingDriver()
+
+        with fake_client(self.server) as client:
+            lock = Lock(client, driver, self.path, "lock-", 1)
+            first = driver.create_lock(client, lock.path)
+            driver.create_lock(client, lock.path)
+
+            cache = lock._children
+            cache.open()
+            assert len(cache.children()) == 2
+
+            third = driver.create_lock(client, lock.path)
+            client.delete(first)
+
+            expected = first.split("/")[-1]
+            deadline = time.time() + 1
+            while expected in cache.children() and time.time() < deadline:
+                time.sleep(0.01)
+
+            children = cache.children()
+            assert len(children) == 2
+            assert children[0].endswith("lock-0000000001")
+            assert children[1] == third.split("/")[-1]
+
+            # nothing gets re-parsed, we only key the new nodes
+            assert driver.keys <= 4
+            cache.close()
+
+    def test_acquisition_order_survives_sequence_wraparound(self):
+        driver = LockDriver()
+
+        with fake_client(self.server) as client:
+            lock = Lock(client, driver, self.path, "lock-", 1)
+            client.ensure_path(self.path)
+            self.server.set_sequence(self.path, 2 ** 31 - 1)
+
+            first = lock.attempt_lock(1)
+            assert first.endswith("lock-2147483647")
+
+            second = driver.create_lock(client, lock.path)
+            assert second.endswith("lock--2147483648")
+
+            # the wrapped node is queued behind the old one, not ahead of it
+            with self.assertRaises(LockTimeout):
+                lock._acquire(second, 0.1)
+
+            assert lock.get_sorted_children() == [first.split("/")[-1]]
+
+    def test_listing_overtaken_by_its_watch_is_sent_again(self):
+        driver = LockDriver()
+
+        with fake_client(self.server) as client:
+            lock = Lock(client, driver, self.path, "lock-", 1)
+            driver.create_lock(client, lock.path)
+
+            cache = lock._children
+            watcher = cache._watcher
+            watched = Event()
+            get_children = client.get_children
+            calls = []
+
+            def fire_and_wait(event):
+                watcher(event)
+                watched.set()
+
+            def slow_get_children(*args, **kwargs):
+                listing = get_children(*args, **kwargs)
+                calls.append(listing)
+
+                if len(calls) == 1:
+                    # the watch fires before we get to apply the listing
+                    driver.create_lock(client, lock.path)
+                    watched.wait(1)
+
+                return listing
+
+            cache._watcher = fire_and_wait
+            client.get_children = slow_get_children
+
+            assert len(cache.children()) == 2
+            assert len(calls) == 2
+
+    def test_waiters_share_one_view(self):
+        driver = _CountingDriver()
+        waiters = 40
+
+        with fake_client(self.server) as client:
+            lock = Lock(client, driver, self.path, "lock-", 1)
+            holder = lock.attempt_lock(5)
+            paths = []
+
+            def contend():
+                path = lock.attempt_lock(5)
+                paths.append(path)
+                lock.release_lock(path)
+
+            threads = [Thread(target=contend) for _ in range(waiters)]
+            for thread in threads:
+                thread.start()
+
+            wait_for_children(client, self.path, waiters + 1)
+
+            lock.release_lock(holder)
+            for thread in threads:
+                thread.join()
+
+            assert len(paths) == waiters
+            assert client.get_children(self.path) == []
+            assert driver.keys < waiters * 8
+
+
+class TestProtectedCreate(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_lock_path"
+
+    def test_lost_create_response_is_recovered(self):
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+            client.ensure_path(self.path)
+            client.inject_failure("create", applied=True)
+
+            path = lock.attempt_lock(1)
+            assert path
+            assert client.get_children(self.path) == [path.split("/")[-1]]
+
+            # nothing left behind to block the next waiter
+            lock.release_lock(path)
+            assert lock.attempt_lock(0.2)
+
+    def test_lost_fallback_create_is_looked_up_once(self):
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+
+            # no lock directory, and then the blocking create is lost too
+            client.inject_failure("create", NoNodeError)
+            client.inject_failure("create")
+
+            calls = []
+            operation = client._operation
+
+            def counted(name, fn, *args):
+                calls.append(name)
+                return operation(name, fn, *args)
+
+            client._operation = counted
+
+            with self.assertRaises(ConnectionLoss):
+                lock.attempt_lock(1)
+
+            # the pipelined listing, then one lookup by guid
+            assert calls.count("get_children") == 2
+
+    def test_unrecoverable_create_is_swept_later(self):
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+            client.ensure_path(self.path)
+            client.inject_failure("create", applied=True)
+
+            # the listing pipelined with the create and the lookup after it
+            client.inject_failure("get_children")
+            client.inject_failure("get_children")
+
+            with self.assertRaises(ConnectionLoss):
+                lock.attempt_lock(1)
+
+            # the orphan is still there, but the next attempt removes it
+            assert len(client.get_children(self.path)) == 1
+
+            path = lock.attempt_lock(1)
+            assert client.get_children(self.path) == [path.split("/")[-1]]
+
+    def test_create_that_never_happened_is_reported(self):
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+            client.ensure_path(self.path)
+            client.inject_failure("create")
+
+            with self.assertRaises(ConnectionLoss):
+                lock.attempt_lock(1)
+
+            assert client.get_children(self.path) == []
+            assert lock.attempt_lock(0.2)
+            assert not lock._orphans
+
+
+class TestRetry(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_lock_path"
+
+    def _retry(self, **kwargs):
+        retry = KazooRetry(**kwargs)
+        retry.retry_exceptions = (ForceRetryError,)
+        return retry
+
+    def test_backs_off_and_gives_up(self):
+        retry = self._retry(max_tries=4, delay=0.05, max_jitter=0)
+
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1, retry)
+            client.ensure_path(self.path)
+            for _ in range(4):
+                client.inject_failure("get_children", NoNodeError)
+
+            start = time.time()
+            with self.assertRaises(RetryFailedError):
+                lock.attempt_lock()
+
+        # 0.05 + 0.1 + 0.2
+        assert time.time() - start >= 0.35
+
+    def test_recovers_once_the_node_can_be_created(self):
+        retry = self._retry(max_tries=4, delay=0.01)
+
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1, retry)
+            client.ensure_path(self.path)
+            client.inject_failure("get_children", NoNodeError)
+            client.inject_failure("get_children", NoNodeError)
+
+            assert lock.attempt_lock(1)
+
+    def test_never_sleeps_past_the_timeout(self):
+        retry = self._retry(max_tries=-1, delay=5)
+
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1, retry)
+            client.ensure_path(self.path)
+            client.inject_failure("get_children", NoNodeError)
+
+            start = time.time()
+            with self.assertRaises(LockTimeout):
+                lock.attempt_lock(1)
+
+            assert time.time() - start < 0.5
+
+    def test_cancel_cuts_the_backoff_short(self):
+        retry = self._retry(max_tries=-1, delay=5)
+        errors = []
+
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1, retry)
+            client.ensure_path(self.path)
+            client.inject_failure("get_children", NoNodeError)
+
+            def attempt():
+                try:
+                    lock.attempt_lock()
+                except CancelledError as err:
+                    errors.append(err)
+
+            thread = Thread(target=attempt)
+            thread.start()
+            time.sleep(0.1)
+
+            start = time.time()
+            lock.cancel()
+            thread.join()
+
+            assert time.time() - start < 0.5
+            assert len(errors) == 1
+            assert client.get_children(self.path) == []
+
+    def test_policy_can_retry_connection_loss(self):
+        retry = KazooRetry(max_tries=3, delay=0.01)
+
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path, retry=retry)
+            client.inject_failure("create")
+
+            assert mutex.acquire()
+            assert mutex._lock.retry is retry
+            mutex.release()
+
+
+class TestLockDirectories(TestCase):
+    def setUp(self):
+        self.path = "/haderp/some_lock_path"
+
+    def test_directories_are_containers(self):
+        server = FakeZooKeeper()
+
+        with fake_client(server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+            lock.release_lock(lock.attempt_lock(1))
+
+            assert supports_containers(client)
+            assert client.exists(self.path)
+
+            server.reap_containers()
+            assert not client.exists("/haderp")
+
+    def test_falls_back_to_cleaning_up_on_release(self):
+        server = FakeZooKeeper(containers=False)
+
+        with fake_client(server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+            other = Lock(client, LockDriver(), self.path, "lock-", 2)
+
+            first = lock.attempt_lock(1)
+            second = other.attempt_lock(1)
+            assert not supports_containers(client)
+
+            lock.release_lock(first)
+            assert client.exists(self.path)
+
+            other.release_lock(second)
+            assert not client.exists(self.path)
+
+    def test_asks_an_old_server_when_the_directory_already_exists(self):
+        server = FakeZooKeeper(containers=False)
+
+        with fake_client(server) as client:
+            client.ensure_path(self.path)
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+
+            # nothing had to be created, so nothing told us yet
+            path = lock.attempt_lock(1)
+            assert supports_containers(client)
+
+            lock.release_lock(path)
+            assert not supports_containers(client)
+            assert not client.exists(self.path)
+
+
+class TestPipelinedAcquire(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_lock_path"
+
+    def test_uncontended_acquire_is_one_round_trip(self):
+        with fake_client(self.server, latency=0.05) as client:
+            client.ensure_path(self.path)
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+
+            start = time.time()
+            path = lock.attempt_lock(1)
+
+            # the listing sent behind the create already has our node
+            assert time.time() - start < 0.09
+            assert client.get_children(self.path) == [path.split("/")[-1]]
+            lock.release_lock(path)
+
+    def test_missing_directory_falls_back_to_a_blocking_create(self):
+        with fake_client(self.server) as client:
+            lock = Lock(client, LockDriver(), self.path, "lock-", 1)
+            calls = []
+            operation = client._operation
+
+            def counted(name, fn, *args):
+                calls.append(name)
+                return operation(name, fn, *args)
+
+            client._operation = counted
+            path = lock.attempt_lock(1)
+
+            assert calls == [
+                # the pipelined create and listing both miss the directory
+                "create",
+                "get_children",
+                # which is created along with its parent
+                "create_container",
+                "create_container",
+                "create_container",
+                # then the node, and a listing with a watch to wait on
+                "create",
+                "get_children"
+            ]
+
+            assert client.get_children(self.path) == [path.split("/")[-1]]
+            lock.release_lock(path)
@@ -0,0 +1,197 @@
+from kazurator import Mutex, ReadWriteLock
+from kazurator.mutex import mutex_snapshots
+from kazurator.read_write_lock import read_write_snapshots
+from kazurator.testing import FakeZooKeeper
+from threading import Event, Thread
+from time import sleep, time
+from unittest import TestCase
+from . import fake_client, wait_for_children
+
+
+class TestSnapshots(TestCase):
+    def setUp(self):
+        self.path = "/haderp/some_path"
+        self.server = FakeZooKeeper()
+
+    def _hold(self, lock, done):
+        def hold():
+            with lock:
+                done.wait()
+
+        thread = Thread(target=hold)
+        thread.start()
+        return thread
+
+    def test_unused_lock(self):
+        with fake_client(self.server) as client:
+            snapshot = Mutex(client, self.path).snapshot()
+
+            assert not snapshot.is_locked
+            assert snapshot.queue_depth == 0
+            assert snapshot.position is None
+
+    def test_mutex_holders_and_queue(self):
+        with fake_client(self.server) as client:
+            holder = Mutex(client, self.path, max_leases=2)
+            other = Mutex(client, self.path, max_leases=2)
+            holder.acquire()
+            other.acquire()
+
+            done = Event()
+            waiter = Mutex(client, self.path, max_leases=2, timeout=5)
+            thread = self._hold(waiter, done)
+            wait_for_children(client, self.path, 3)
+
+            snapshot = waiter.snapshot()
+            assert snapshot.is_locked
+            assert len(snapshot.holders) == 2
+            assert snapshot.queue_depth == 1
+            assert snapshot.position == 2
+            assert holder.snapshot().position == 0
+
+            holder.release()
+            while waiter.snapshot().position != 1:
+                sleep(0.01)
+
+            done.set()
+            thread.join()
+            other.release()
+
+    def test_snapshots_are_served_from_the_watch(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path)
+            mutex.acquire()
+            mutex.snapshot()
+
+            calls = []
+            get_children = client.get_children
+            client.get_children = lambda *a, **kw: (
+                calls.append(a) or get_children(*a, **kw)
+            )
+
+            for _ in range(10):
+                assert mutex.snapshot().is_locked
+
+            assert calls == []
+
+            # the watch keeps it current
+            mutex.release()
+            while mutex.snapshot().is_locked:
+                sleep(0.01)
+
+            assert len(calls) == 1
+            mutex.unwatch()
+
+    def test_read_write_snapshot(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 5)
+            lock.read_lock.acquire()
+
+            done = Event()
+            other = ReadWriteLock(client, self.path, 5)
+            writer = self._hold(other.write_lock, done)
+            wait_for_children(client, self.path, 2)
+
+            reader = ReadWriteLock(client, self.path, 5)
+            queued = self._hold(reader.read_lock, done)
+            wait_for_children(client, self.path, 3)
+
+            snapshot = lock.snapshot()
+            assert snapshot.is_locked
+            assert len(snapshot.holders) == 1
+            assert snapshot.readers_waiting == 1
+            assert snapshot.writers_waiting == 1
+            assert snapshot.position == 0
+            assert reader.snapshot().position == 2
+
+            lock.read_lock.release()
+            while not other.snapshot().position == 0:
+                sleep(0.01)
+
+            snapshot = other.snapshot()
+            assert snapshot.holders[0].endswith("__WRIT__0000000001")
+            assert snapshot.readers_waiting == 1
+
+            done.set()
+            writer.join()
+            queued.join()
+
+
+class TestBulkSnapshots(TestCase):
+    def setUp(self):
+        self.paths = ["/haderp/%d" % i for i in range(50)]
+        self.server = FakeZooKeeper()
+
+    def test_read_write_snapshots(self):
+        with fake_client(self.server) as client:
+            reader = ReadWriteLock(client, self.paths[1]).read_lock
+            writer = ReadWriteLock(client, self.paths[2]).write_lock
+            reader.acquire()
+            writer.acquire()
+
+            paths = []
+            for path, snapshot in read_write_snapshots(client, self.paths, 8):
+                paths.append(path)
+
+                if path == self.paths[1]:
+                    assert len(snapshot.readers) == 1
+                    assert snapshot.writers == []
+                    assert snapshot.holders == snapshot.readers
+                elif path == self.paths[2]:
+                    assert snapshot.readers == []
+                    assert snapshot.holders == snapshot.writers
+                else:
+                    assert not snapshot.is_locked
+
+            assert paths == self.paths
+
+            reader.release()
+            writer.release()
+
+    def test_read_write_snapshots_split_waiters(self):
+        with fake_client(self.server) as client:
+            path = self.paths[0]
+            done = Event()
+            reader = self._hold(ReadWriteLock(client, path).read_lock, done)
+            wait_for_children(client, path, 1)
+
+            writer = self._hold(ReadWriteLock(client, path).write_lock, done)
+            wait_for_children(client, path, 2)
+
+            [(_, snapshot)] = read_write_snapshots(client, [path])
+            assert len(snapshot.readers) == 1
+            assert len(snapshot.writers) == 1
+            assert snapshot.holders == snapshot.readers
+            assert snapshot.waiters == snapshot.writers
+
+            done.set()
+            reader.join()
+            writer.join()
+
+    def test_mutex_snapshots(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.paths[0])
+
+            with mutex:
+                snapshots = dict(mutex_snapshots(client, self.paths[:3]))
+
+            assert len(snapshots[self.paths[0]].holders) == 1
+            assert snapshots[self.paths[0]].queue_depth == 0
+            assert not snapshots[self.paths[1]].is_locked
+
+    def test_requests_are_pipelined(self):
+        with fake_client(self.server, latency=0.01) as client:
+            start = time()
+            assert len(list(read_write_snapshots(client, self.paths))) == 50
+
+            # 50 sequential round trips would take at least half a second
+            assert time() - start < 0.25
+
+    def _hold(self, lock, done):
+        def hold():
+            with lock:
+                done.wait()
+
+        thread = Thread(target=hold)
+        thread.start()
+        return thread
@@ -0,0 +1,135 @@
+from kazoo.exceptions import ConnectionLoss, LockTimeout
+from kazurator import LockSet, Mutex, ReadWriteLock
+from kazurator.testing import FakeZooKeeper
+from threading import Thread, ThreadError
+from unittest import TestCase
+from . import fake_client
+
+
+class TestLockSet(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.paths = ["/haderp/a", "/haderp/b", "/haderp/c"]
+
+    def _count(self, client):
+        return sum(len(client.get_children(p)) for p in self.paths)
+
+    def test_paths_are_sorted(self):
+        with fake_client(self.server) as client:
+            lock_set = LockSet(client, mutexes=reversed(self.paths))
+            assert lock_set.paths == self.paths
+
+    def test_duplicate_paths_are_rejected(self):
+        with fake_client(self.server) as client:
+            with self.assertRaises(ValueError):
+                LockSet(client, reads=["/a"], writes=["/a"])
+
+    def test_acquire_creates_every_node_in_one_transaction(self):
+        with fake_client(self.server) as client:
+            lock_set = LockSet(client, mutexes=self.paths, timeout=0.5)
+
+            # the first commit fails because the directories are missing,
+            # so this only succeeds if the retry is a single transaction
+            client.ensure_path("/haderp")
+            with lock_set:
+                assert lock_set.is_acquired
+                assert self._count(client) == 3
+
+            assert not lock_set.is_acquired
+            assert self._count(client) == 0
+
+    def test_failed_transaction_creates_nothing(self):
+        with fake_client(self.server) as client:
+            client.ensure_path(self.paths[0])
+            lock_set = LockSet(client, mutexes=self.paths, timeout=0.5)
+            client.inject_failure("create_container")
+
+            with self.assertRaises(ConnectionLoss):
+                lock_set.acquire()
+
+            assert client.get_children(self.paths[0]) == []
+
+    def test_acquire_waits_for_held_members(self):
+        with fake_client(self.server) as client:
+            lock_set = LockSet(
+                client,
+                reads=self.paths[:1],
+                writes=self.paths[1:],
+                timeout=0.2
+            )
+
+            with ReadWriteLock(client, self.paths[2]).write_lock:
+                with self.assertRaises(LockTimeout):
+                    lock_set.acquire()
+
+                # the nodes queued for the other paths are cleaned up too
+                assert len(client.get_children(self.paths[0])) == 0
+                assert len(client.get_children(self.paths[1])) == 0
+
+            assert lock_set.acquire()
+            lock_set.release()
+
+    def test_read_members_share_with_other_readers(self):
+        with fake_client(self.server) as client:
+            lock_set = LockSet(client, reads=self.paths, timeout=0.5)
+
+            with ReadWriteLock(client, self.paths[1]).read_lock:
+                with lock_set:
+                    assert self._count(client) == 4
+
+    def test_mutex_members_exclude_mutexes(self):
+        with fake_client(self.server) as client:
+            lock_set = LockSet(client, mutexes=self.paths, timeout=0.5)
+
+            with lock_set:
+                with self.assertRaises(LockTimeout):
+                    Mutex(client, self.paths[0], timeout=0.1).acquire()
+
+    def test_overlapping_sets_do_not_deadlock(self):
+        with fake_client(self.server) as client:
+            results = []
+
+            def contend(paths):
+                lock_set = LockSet(client, writes=paths, timeout=5)
+
+                for _ in range(20):
+                    with lock_set:
+                        pass
+
+                results.append(True)
+
+            threads = [
+                Thread(target=contend, args=(self.paths,)),
+                Thread(target=contend, args=(list(reversed(self.paths)),)),
+                Thread(target=contend, args=(self.paths[1:],))
+            ]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            assert results == [True, True, True]
+            assert self._count(client) == 0
+
+    def test_failed_release_can_be_retried(self):
+        with fake_client(self.server) as client:
+            lock_set = LockSet(client, mutexes=self.paths, timeout=0.5)
+            lock_set.acquire()
+            client.inject_failure("transaction")
+
+            with self.assertRaises(ConnectionLoss):
+                lock_set.release()
+
+            assert lock_set.is_acquired
+            assert self._count(client) == 3
+
+            lock_set.release()
+            assert not lock_set.is_acquired
+            assert self._count(client) == 0
+
+    def test_release_raises_thread_error_when_not_acquired(self):
+        with fake_client(self.server) as client:
+            with self.assertRaises(ThreadError):
+                LockSet(client, mutexes=self.paths).release()
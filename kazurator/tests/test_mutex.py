@@ -1,9 +1,13 @@
-from kazoo.exceptions import LockTimeout
-from kazurator import Mutex
+from kazoo.exceptions import CancelledError, LockTimeout, NoNodeError
+from kazurator import Mutex, ReadWriteLock
+from kazurator.mutex import LockHandle
+from kazurator.read_write_lock import _shared_leases
+from kazurator.testing import FakeZooKeeper
 from sys import maxsize
-from threading import Thread, ThreadError
-from unittest import TestCase
-from . import kazoo_client
+from time import sleep, time
+from threading import Event, Thread, ThreadError
+from unittest import TestCase, skipIf
+from . import fake_client, kazoo_client, wait_for_children
 
 
 class TestMutex(TestCase):
@@ -97,3 +101,516 @@ class TestMutex(TestCase):
                 mutex.release()
 
             assert str(err.exception) == message
+
+    def test_release_is_not_blocked_by_a_waiting_thread(self):
+        with kazoo_client() as client:
+            mutex = self._create_mutex(client, max_leases=1, timeout=5)
+            waiting = Event()
+            acquired = []
+
+            def waiter():
+                waiting.set()
+                acquired.append(bool(mutex.acquire()))
+                mutex.release()
+
+            mutex.acquire()
+            thread = Thread(target=waiter)
+            thread.start()
+            waiting.wait()
+
+            # the waiter is parked in ZooKeeper, but we can still use the
+            # instance from this thread
+            assert mutex.is_owned_by_current_thread
+            mutex.release()
+
+            thread.join()
+            assert acquired == [True]
+            assert not mutex.is_acquired
+
+    def test_threads_sharing_an_instance_wait_concurrently(self):
+        with kazoo_client() as client:
+            holders = [self._create_mutex(client, max_leases=2)
+                       for _ in range(2)]
+            shared = self._create_mutex(client, max_leases=2, timeout=5)
+            acquired = []
+
+            def waiter():
+                acquired.append(bool(shared.acquire()))
+
+            for holder in holders:
+                holder.acquire()
+
+            threads = [Thread(target=waiter) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+
+            # both threads have queued a node despite sharing the instance
+            wait_for_children(client, self.path, 4)
+
+            for holder in holders:
+                holder.release()
+
+            for thread in threads:
+                thread.join()
+
+            assert acquired == [True, True]
+
+
+try:
+    import gevent
+    from kazoo.handlers.gevent import SequentialGeventHandler
+except ImportError:
+    gevent = None
+
+
+@skipIf(gevent is None, "gevent is not installed")
+class TestGreenletOwnership(TestCase):
+    def setUp(self):
+        self.path = "/haderp/some_path"
+        self.server = FakeZooKeeper()
+
+    def test_greenlets_do_not_share_ownership(self):
+        with fake_client(self.server, handler=SequentialGeventHandler()) \
+                as client:
+            mutex = Mutex(client, self.path, timeout=0.1)
+            mutex.acquire()
+
+            def contend():
+                assert not mutex.is_owned_by_current_thread
+                with self.assertRaises(LockTimeout):
+                    mutex.acquire()
+
+            gevent.spawn(contend).get()
+
+            assert mutex.is_owned_by_current_thread
+            mutex.release()
+
+    def test_thousands_of_contenders(self):
+        with fake_client(self.server, handler=SequentialGeventHandler()) \
+                as client:
+            mutex = Mutex(client, self.path)
+            holders = []
+
+            def contend():
+                with mutex:
+                    holders.append(gevent.getcurrent())
+                    gevent.sleep(0)  # let everyone else pile up behind us
+                    assert holders[-1] is gevent.getcurrent()
+
+            greenlets = [gevent.spawn(contend) for _ in range(2000)]
+            gevent.joinall(greenlets, raise_error=True)
+
+            assert len(set(holders)) == 2000
+            assert client.get_children(self.path) == []
+
+
+class TestLockHandles(TestCase):
+    def setUp(self):
+        self.path = "/haderp/some_path"
+        self.server = FakeZooKeeper()
+
+    def test_acquire_returns_a_handle(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path)
+            assert mutex.handle is None
+
+            with mutex as handle:
+                assert mutex.handle is handle
+                assert handle.path == \
+                    self.path + "/" + client.get_children(self.path)[0]
+                assert handle.sequence == 0
+                assert mutex.acquire() is handle  # re-entering
+                mutex.release()
+
+            assert mutex.handle is None
+
+    def test_tokens_increase_across_holders_and_directories(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path)
+            tokens = []
+
+            for _ in range(2):
+                with mutex as handle:
+                    tokens.append(handle.token)
+
+            # the sequence starts over in a new directory, the token doesn't
+            client.delete(self.path)
+            with mutex as handle:
+                assert handle.sequence == 0
+                tokens.append(handle.token)
+
+            assert tokens == sorted(set(tokens))
+
+    def test_sequence_survives_the_counter_wrapping(self):
+        with fake_client(self.server) as client:
+            client.ensure_path(self.path)
+            self.server.set_sequence(self.path, 2 ** 31 - 1)
+
+            mutex = Mutex(client, self.path)
+            with mutex as handle:
+                assert handle.sequence == 2 ** 31 - 1
+
+            # the delete bumped the counter too
+            with mutex as handle:
+                assert handle.sequence == -2 ** 31 + 1
+
+    def test_handles_are_lost_when_the_connection_is(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path)
+
+            with mutex as handle:
+                token = handle.token
+                assert not handle.is_lost
+
+                client.suspend()
+                assert handle.is_lost
+                client.resume()
+
+            with mutex as handle:
+                assert handle.token > token
+                client.expire_session()
+                assert handle.is_lost
+
+                # the node went with the session
+                with self.assertRaises(NoNodeError):
+                    LockHandle(client, handle.path).token
+
+            # nothing is listening once the lock is released
+            assert mutex._listener not in client.state_listeners
+
+
+class TestStickyMutex(TestCase):
+    def setUp(self):
+        self.path = "/haderp/some_path"
+        self.server = FakeZooKeeper()
+
+    def test_uncontended_cycles_keep_the_node(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path, sticky=True)
+
+            with mutex as handle:
+                node = handle.path
+
+            assert not mutex.is_acquired
+            assert client.get_children(self.path) == [node.rsplit("/")[-1]]
+
+            calls = []
+            operation = client._operation
+
+            def counted(name, fn, *args):
+                calls.append(name)
+                return operation(name, fn, *args)
+
+            client._operation = counted
+
+            for _ in range(100):
+                with mutex as handle:
+                    assert handle.path == node
+
+            assert calls == []
+
+            mutex.flush()
+            assert client.get_children(self.path) == []
+
+    def test_contenders_get_the_lock(self):
+        with fake_client(self.server) as client:
+            with fake_client(self.server) as other:
+                mutex = Mutex(client, self.path, sticky=True)
+
+                with mutex as handle:
+                    node = handle.path
+
+                contender = Mutex(other, self.path, timeout=1)
+                with contender:
+                    assert len(other.get_children(self.path)) == 1
+
+                # the kept node was given up, so this queues a new one
+                with mutex as handle:
+                    assert handle.path != node
+
+                mutex.flush()
+                assert other.get_children(self.path) == []
+
+    def test_contenders_arriving_while_held(self):
+        with fake_client(self.server) as client:
+            with fake_client(self.server) as other:
+                mutex = Mutex(client, self.path, sticky=True)
+                contender = Mutex(other, self.path, timeout=1)
+                acquired = Event()
+
+                with mutex:
+                    pass
+
+                with mutex:
+                    def contend():
+                        with contender:
+                            acquired.set()
+
+                    thread = Thread(target=contend)
+                    thread.start()
+
+                    wait_for_children(client, self.path, 2)
+
+                thread.join()
+                assert acquired.is_set()
+
+    def test_kept_node_survives_a_suspension(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path, sticky=True)
+
+            with mutex as handle:
+                node = handle.path
+
+            client.suspend()
+            client.resume()
+
+            # the session lived through it, and so did the node
+            with mutex as handle:
+                assert handle.path == node
+
+            mutex.flush()
+            assert client.get_children(self.path) == []
+
+    def test_parking_resumes_after_a_suspension_while_held(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path, sticky=True)
+
+            with mutex as handle:
+                node = handle.path
+                client.suspend()
+                client.resume()
+
+            # the suspended hold was given up for real
+            assert client.get_children(self.path) == []
+
+            with mutex as handle:
+                assert handle.path != node
+                node = handle.path
+
+            # and the next one is kept again
+            assert client.get_children(self.path) == [node.rsplit("/")[-1]]
+
+            with mutex as handle:
+                assert handle.path == node
+
+            mutex.flush()
+
+    def test_lost_session_drops_the_kept_node(self):
+        with fake_client(self.server) as client:
+            mutex = Mutex(client, self.path, sticky=True)
+
+            with mutex as handle:
+                node = handle.path
+
+            client.expire_session()
+
+            with mutex as handle:
+                assert handle.path != node
+                node = handle.path
+
+            assert client.get_children(self.path) == [node.rsplit("/")[-1]]
+            mutex.flush()
+            assert client.get_children(self.path) == []
+
+    def test_a_failed_contender_watch_gives_up_the_kept_node(self):
+        with fake_client(self.server) as client:
+            with fake_client(self.server) as other:
+                mutex = Mutex(client, self.path, sticky=True)
+
+                with mutex:
+                    pass
+
+                # the watch can't be set again after it fires
+                client.inject_failure("get_children")
+
+                with Mutex(other, self.path, timeout=1):
+                    assert len(other.get_children(self.path)) == 1
+
+    def test_write_locks_can_be_sticky(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, sticky_writes=True)
+
+            with lock.write_lock:
+                pass
+
+            assert len(client.get_children(self.path)) == 1
+
+            with ReadWriteLock(client, self.path, timeout=1).read_lock:
+                assert len(client.get_children(self.path)) == 1
+
+
+class TestCancellation(TestCase):
+    def setUp(self):
+        self.path = "/haderp/some_path"
+        self.server = FakeZooKeeper()
+
+    def _contend(self, lock, errors):
+        def contend():
+            try:
+                lock.acquire()
+            except Exception as err:
+                errors.append(err)
+
+        thread = Thread(target=contend)
+        thread.start()
+        return thread
+
+    def test_cancel_wakes_waiters_and_removes_their_nodes(self):
+        with fake_client(self.server) as client:
+            holder = Mutex(client, self.path)
+            waiter = Mutex(client, self.path)
+            errors = []
+
+            with holder:
+                threads = [self._contend(waiter, errors) for _ in range(3)]
+                wait_for_children(client, self.path, 4)
+
+                start = time()
+                waiter.cancel()
+
+                for thread in threads:
+                    thread.join()
+
+                assert time() - start < 1
+                assert len(errors) == 3
+                assert all(isinstance(e, CancelledError) for e in errors)
+                assert len(client.get_children(self.path)) == 1
+
+            # cancelling only affects acquires already in progress
+            with waiter:
+                pass
+
+    def test_cancel_read_write_lock(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path)
+            errors = []
+
+            with ReadWriteLock(client, self.path).write_lock:
+                thread = self._contend(lock.read_lock, errors)
+                wait_for_children(client, self.path, 2)
+
+                lock.cancel()
+                thread.join()
+
+            assert isinstance(errors[0], CancelledError)
+
+    def test_timeout_covers_every_wakeup(self):
+        with fake_client(self.server) as client:
+            holder = Mutex(client, self.path)
+            waiter = Mutex(client, self.path, timeout=0.3)
+            stop = Event()
+
+            with holder:
+                # queued between the holder and the waiter
+                fillers = [
+                    client.create(
+                        self.path + "/lock-",
+                        ephemeral=True,
+                        sequence=True
+                    )
+                    for _ in range(6)
+                ]
+
+                def churn():
+                    # wake the waiter every so often without letting it in
+                    for filler in reversed(fillers):
+                        if stop.wait(0.15):
+                            break
+
+                        client.delete(filler)
+
+                thread = Thread(target=churn)
+                thread.start()
+
+                start = time()
+                try:
+                    with self.assertRaises(LockTimeout):
+                        waiter.acquire()
+                finally:
+                    stop.set()
+                    thread.join()
+
+                assert time() - start < 0.6
+
+    def _wait_to_join(self):
+        # until a reader is waiting on another's shared lease
+        while not any(lease.waiting for lease in _shared_leases.values()):
+            sleep(0.01)
+
+    def test_cancel_readers_waiting_to_join_a_shared_lease(self):
+        with fake_client(self.server) as client:
+            first = ReadWriteLock(client, self.path, share_reads=True)
+            joiner = ReadWriteLock(client, self.path, share_reads=True)
+            errors = []
+
+            acquired = Event()
+
+            def read():
+                with first.read_lock:
+                    acquired.set()
+
+            with ReadWriteLock(client, self.path).write_lock:
+                queued = Thread(target=read)
+                queued.start()
+                wait_for_children(client, self.path, 2)
+
+                joining = self._contend(joiner.read_lock, errors)
+                self._wait_to_join()
+
+                joiner.cancel()
+                joining.join()
+
+                assert isinstance(errors[0], CancelledError)
+                assert not joiner.read_lock.is_acquired
+
+            # the reader it was waiting on still gets in
+            queued.join()
+            assert acquired.is_set()
+            assert len(errors) == 1
+
+    def test_shared_read_timeout_covers_waiting_to_join(self):
+        with fake_client(self.server) as client:
+            first = ReadWriteLock(client, self.path, 0.3, share_reads=True)
+            joiner = ReadWriteLock(client, self.path, 0.3, share_reads=True)
+            errors = []
+
+            with ReadWriteLock(client, self.path).write_lock:
+                queued = self._contend(first.read_lock, errors)
+                wait_for_children(client, self.path, 2)
+
+                start = time()
+                with self.assertRaises(LockTimeout):
+                    joiner.read_lock.acquire()
+
+                # not a wait to join and then a full timeout of its own
+                assert time() - start < 0.45
+                queued.join()
+
+            assert isinstance(errors[0], LockTimeout)
+
+    def test_cancel_upgrade(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, share_reads=True)
+            errors = []
+            held = []
+
+            def upgrade():
+                with lock.read_lock:
+                    try:
+                        lock.upgrade()
+                    except Exception as err:
+                        errors.append(err)
+
+                    held.append(lock.read_lock.is_owned_by_current_thread)
+
+            with ReadWriteLock(client, self.path).read_lock:
+                thread = Thread(target=upgrade)
+                thread.start()
+                wait_for_children(client, self.path, 3)
+
+                lock.cancel()
+                thread.join()
+
+                assert isinstance(errors[0], CancelledError)
+                assert held == [True]
+                assert len(client.get_children(self.path)) == 1
@@ -0,0 +1,108 @@
+from kazurator.participants import ParticipantIndex, parse
+from unittest import TestCase
+
+GUID = "9d1b3f0e-2f51-4c1a-9f55-4b0b1c1e2d3f"
+
+
+def _index(nodes=()):
+    return ParticipantIndex(("lock-",), nodes)
+
+
+def test_parse_protected_node():
+    participant = parse("_c_{}-lock-0000000042".format(GUID), ("lock-",))
+
+    assert participant.sequence == 42
+    assert participant.lock_name == "lock-"
+    assert participant.guid == GUID
+
+
+def test_parse_unprotected_node():
+    participant = parse("__READ__0000000007", ("__WRIT__", "__READ__"))
+
+    assert participant.sequence == 7
+    assert participant.lock_name == "__READ__"
+    assert participant.guid is None
+
+
+def test_parse_negative_sequences():
+    assert parse("lock--000000001", ("lock-",)).sequence == -1
+    assert parse("lock--2147483648", ("lock-",)).sequence == -2 ** 31
+
+
+def test_parse_ignores_other_nodes():
+    assert parse("ohai_there", ("lock-",)) is None
+    assert parse("lock-abc", ("lock-",)) is None
+
+
+class TestParticipantIndex(TestCase):
+    def test_orders_by_sequence(self):
+        index = _index([
+            "_c_{}-lock-0000000010".format(GUID),
+            "lock-0000000002",
+            "lock-0000000100"
+        ])
+
+        assert [p.sequence for p in index] == [2, 10, 100]
+        assert index.position("lock-0000000100") == 2
+        assert index.at(1).guid == GUID
+
+    def test_orders_across_wraparound(self):
+        index = _index(["lock--2147483648", "lock-2147483646"])
+        index.add("lock--2147483647")
+        index.add("lock-2147483647")
+
+        assert index.nodes() == [
+            "lock-2147483646",
+            "lock-2147483647",
+            "lock--2147483648",
+            "lock--2147483647"
+        ]
+
+    def test_add_and_discard(self):
+        index = _index(["lock-0000000001", "lock-0000000003"])
+
+        assert index.add("lock-0000000002")
+        assert not index.add("lock-0000000002")
+        assert not index.add("ohai_there")
+        assert index.position("lock-0000000002") == 1
+
+        assert index.discard("lock-0000000001")
+        assert not index.discard("lock-0000000001")
+        assert index.position("lock-0000000001") is None
+        assert index.nodes() == ["lock-0000000002", "lock-0000000003"]
+
+    def test_replace_applies_a_new_listing(self):
+        nodes = ["lock-%010d" % i for i in range(100)]
+        index = _index(nodes)
+
+        index.replace(nodes[1:] + ["lock-0000000100"])
+        assert len(index) == 100
+        assert index.at(0).sequence == 1
+        assert index.at(99).sequence == 100
+
+        index.replace(nodes[50:])
+        assert index.nodes() == nodes[50:]
+
+        index.replace([])
+        assert len(index) == 0
+
+    def test_first_tracks_each_lock_name(self):
+        index = ParticipantIndex(("__READ__", "__WRIT__"), [
+            "__READ__0000000001",
+            "__WRIT__0000000003",
+            "__READ__0000000004"
+        ])
+
+        assert index.count("__WRIT__") == 1
+        assert index.first("__READ__").sequence == 1
+        assert index.first("__WRIT__", before="__READ__0000000004")
+        assert not index.first("__WRIT__", before="__READ__0000000001")
+
+        index.add("__WRIT__0000000002")
+        assert index.first("__WRIT__").sequence == 2
+
+        index.discard("__WRIT__0000000002")
+        index.replace(["__READ__0000000004", "__WRIT__0000000005"])
+        assert index.count("__READ__") == 1
+        assert index.first("__WRIT__").sequence == 5
+        assert not index.first("__WRIT__", before="__READ__0000000004")
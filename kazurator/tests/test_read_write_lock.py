@@ -1,7 +1,19 @@
-from kazoo.exceptions import LockTimeout
+from kazoo.exceptions import ConnectionLoss, LockTimeout, NoNodeError
 from kazurator import ReadWriteLock
+from kazurator.read_write_lock import (
+    READ_LOCK_NAME,
+    WRITE_LOCK_NAME,
+    _LockDriver,
+    _read_is_acquirable,
+    _read_is_acquirable_in,
+    _shared_leases
+)
+from kazurator.testing import FakeZooKeeper
+from random import Random
+from threading import Event, Semaphore, Thread, ThreadError
+from time import sleep
 from unittest import TestCase
-from . import kazoo_client
+from . import fake_client, kazoo_client, wait_for_children
 
 
 class TestReadWriteLock(TestCase):
@@ -119,3 +131,384 @@ class TestReadWriteLock(TestCase):
 
                     assert nodes[0].startswith(self.path)
                     assert nodes[0].endswith("__WRIT__0000000000")
+
+
+class TestReadAcquirability(TestCase):
+    def test_index_agrees_with_child_scan(self):
+        rand = Random(3)
+        driver = _LockDriver()
+
+        for _ in range(20):
+            children = [
+                "{}{:010d}".format(
+                    WRITE_LOCK_NAME if rand.random() < 0.2 else READ_LOCK_NAME,
+                    i
+                )
+                for i in range(50)
+            ]
+
+            index = driver.create_index(READ_LOCK_NAME, children)
+            for child in children:
+                if READ_LOCK_NAME in child:
+                    assert _read_is_acquirable_in(index, child) == \
+                        _read_is_acquirable(children, child)
+
+    def test_index_raises_when_node_not_found(self):
+        index = _LockDriver().create_index(READ_LOCK_NAME, [])
+
+        with self.assertRaises(NoNodeError):
+            _read_is_acquirable_in(index, "__READ__0000000001")
+
+
+class TestSharedReads(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_path"
+
+    def _create_lock(self, client, timeout=0.5):
+        return ReadWriteLock(client, self.path, timeout, share_reads=True)
+
+    def _in_thread(self, fn):
+        errors = []
+
+        def run():
+            try:
+                fn()
+            except Exception as err:
+                errors.append(err)
+
+        thread = Thread(target=run)
+        thread.start()
+        thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def _hold_in_thread(self, lock, acquired, done):
+        def hold():
+            with lock:
+                acquired.release()
+                done.wait()
+
+        thread = Thread(target=hold)
+        thread.start()
+        return thread
+
+    def test_local_readers_share_one_node(self):
+        with fake_client(self.server) as client:
+            first = self._create_lock(client)
+            second = self._create_lock(client)
+            acquired = Semaphore(0)
+            done = Event()
+
+            with first.read_lock:
+                threads = [
+                    self._hold_in_thread(lock.read_lock, acquired, done)
+                    for lock in (first, second, second)
+                ]
+
+                for _ in threads:
+                    acquired.acquire()
+
+                assert len(client.get_children(self.path)) == 1
+                done.set()
+
+                for thread in threads:
+                    thread.join()
+
+                assert len(client.get_children(self.path)) == 1
+
+            assert client.get_children(self.path) == []
+
+    def test_readers_in_other_processes_get_their_own_node(self):
+        with fake_client(self.server) as client:
+            with fake_client(self.server) as other:
+                with self._create_lock(client).read_lock:
+                    with self._create_lock(other).read_lock:
+                        assert len(client.get_children(self.path)) == 2
+
+    def test_local_readers_stop_joining_once_a_writer_queues(self):
+        with fake_client(self.server) as client:
+            with fake_client(self.server) as other:
+                reader = self._create_lock(client)
+                writer = ReadWriteLock(other, self.path, 5)
+
+                with reader.read_lock:
+                    thread = Thread(target=writer.write_lock.acquire)
+                    thread.start()
+
+                    wait_for_children(client, self.path, 2)
+
+                    # the writer watch closes the lease asynchronously
+                    while _shared_leases:
+                        sleep(0.01)
+
+                    late = self._create_lock(client, timeout=0.2)
+                    with self.assertRaises(LockTimeout):
+                        self._in_thread(late.read_lock.acquire)
+
+                thread.join()
+                assert writer.write_lock.is_acquired
+
+    def test_local_readers_stop_joining_once_the_session_expires(self):
+        with fake_client(self.server) as client:
+            with fake_client(self.server) as other:
+                reader = self._create_lock(client)
+                writer = ReadWriteLock(other, self.path, 0.2)
+                late = self._create_lock(client)
+
+                reader.read_lock.acquire()
+                client.expire_session()
+
+                def read():
+                    with late.read_lock:
+                        assert len(client.get_children(self.path)) == 1
+
+                        with self.assertRaises(LockTimeout):
+                            writer.write_lock.acquire()
+
+                self._in_thread(read)
+                reader.read_lock.release()
+
+                assert _shared_leases == {}
+
+    def test_write_lock_holder_can_still_read(self):
+        with fake_client(self.server) as client:
+            lock = self._create_lock(client)
+
+            with lock.write_lock:
+                with lock.read_lock:
+                    assert len(client.get_children(self.path)) == 2
+
+
+class TestDowngradeAndUpgrade(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_path"
+
+    def _children(self, client):
+        return sorted(
+            client.get_children(self.path),
+            key=lambda child: child[-10:]
+        )
+
+    def _queue(self, lock, acquired):
+        def run():
+            with lock:
+                acquired.set()
+
+        thread = Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_downgrade(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1)
+            lock.write_lock.acquire()
+
+            reader = ReadWriteLock(client, self.path, 1)
+            acquired = Event()
+            thread = self._queue(reader.read_lock, acquired)
+            wait_for_children(client, self.path, 2)
+
+            assert lock.downgrade()
+            assert not lock.write_lock.is_owned_by_current_thread
+            assert lock.read_lock.is_owned_by_current_thread
+            assert acquired.wait(1)
+
+            thread.join()
+            lock.read_lock.release()
+            assert client.get_children(self.path) == []
+
+    def test_downgrade_refuses_to_let_a_queued_writer_in(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1)
+            lock.write_lock.acquire()
+
+            writer = ReadWriteLock(client, self.path, 1)
+            acquired = Event()
+            thread = self._queue(writer.write_lock, acquired)
+            wait_for_children(client, self.path, 2)
+
+            assert not lock.downgrade()
+            assert lock.write_lock.is_owned_by_current_thread
+            assert len(client.get_children(self.path)) == 2
+
+            lock.write_lock.release()
+            thread.join()
+            assert acquired.is_set()
+
+    def test_upgrade_waits_for_other_readers(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1)
+            lock.read_lock.acquire()
+
+            done = Event()
+            reader = ReadWriteLock(client, self.path, 1)
+
+            def read():
+                with reader.read_lock:
+                    done.wait()
+
+            thread = Thread(target=read)
+            thread.start()
+            wait_for_children(client, self.path, 2)
+
+            # the upgrade has to happen on the thread holding the read lock,
+            # so the other reader is let go from a timer
+            releaser = Thread(target=lambda: (sleep(0.1), done.set()))
+            releaser.start()
+
+            assert lock.upgrade()
+            assert lock.write_lock.is_owned_by_current_thread
+            assert not lock.read_lock.is_owned_by_current_thread
+
+            children = self._children(client)
+            assert len(children) == 1
+            assert WRITE_LOCK_NAME in children[0]
+
+            lock.write_lock.release()
+            thread.join()
+            releaser.join()
+
+    def test_upgrade_refuses_when_a_writer_is_queued(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1)
+            lock.read_lock.acquire()
+
+            writer = ReadWriteLock(client, self.path, 1)
+            acquired = Event()
+            thread = self._queue(writer.write_lock, acquired)
+            wait_for_children(client, self.path, 2)
+
+            assert not lock.upgrade()
+            assert lock.read_lock.is_owned_by_current_thread
+            assert len(client.get_children(self.path)) == 2
+
+            lock.read_lock.release()
+            thread.join()
+            assert acquired.is_set()
+
+    def test_sole_shared_reader_can_upgrade(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1, share_reads=True)
+            lock.read_lock.acquire()
+
+            assert lock.upgrade()
+            assert lock.write_lock.is_owned_by_current_thread
+            assert not _shared_leases
+
+            children = self._children(client)
+            assert len(children) == 1
+            assert WRITE_LOCK_NAME in children[0]
+
+            lock.write_lock.release()
+            assert client.get_children(self.path) == []
+
+    def test_upgrade_refuses_while_the_lease_is_shared(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1, share_reads=True)
+            lock.read_lock.acquire()
+
+            done = Event()
+            joined = Event()
+            other = ReadWriteLock(client, self.path, 1, share_reads=True)
+
+            def read():
+                with other.read_lock:
+                    joined.set()
+                    done.wait()
+
+            thread = Thread(target=read)
+            thread.start()
+            assert joined.wait(1)
+
+            assert not lock.upgrade()
+            assert lock.read_lock.is_owned_by_current_thread
+
+            done.set()
+            thread.join()
+            lock.read_lock.release()
+            assert client.get_children(self.path) == []
+
+    def test_upgrade_timeout_keeps_the_read_lock(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 0.1)
+            lock.read_lock.acquire()
+
+            done = Event()
+            reader = ReadWriteLock(client, self.path, 1)
+
+            def read():
+                with reader.read_lock:
+                    done.wait()
+
+            thread = Thread(target=read)
+            thread.start()
+            wait_for_children(client, self.path, 2)
+
+            with self.assertRaises(LockTimeout):
+                lock.upgrade()
+
+            assert lock.read_lock.is_owned_by_current_thread
+            assert len(client.get_children(self.path)) == 2
+
+            done.set()
+            thread.join()
+            lock.read_lock.release()
+
+    def test_failed_downgrade_removes_its_read_node(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1)
+            lock.write_lock.acquire()
+            client.inject_failure("get_children")
+
+            with self.assertRaises(ConnectionLoss):
+                lock.downgrade()
+
+            assert lock.write_lock.is_owned_by_current_thread
+            assert len(client.get_children(self.path)) == 1
+
+            lock.write_lock.release()
+
+    def test_failed_upgrade_reopens_the_shared_lease(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1, share_reads=True)
+            lock.read_lock.acquire()
+            client.inject_failure("get_children")
+
+            with self.assertRaises(ConnectionLoss):
+                lock.upgrade()
+
+            assert lock.read_lock.is_owned_by_current_thread
+            assert len(client.get_children(self.path)) == 1
+
+            # other local readers join our node again
+            other = ReadWriteLock(client, self.path, 1, share_reads=True)
+            counts = []
+
+            def read():
+                with other.read_lock:
+                    counts.append(len(client.get_children(self.path)))
+
+            thread = Thread(target=read)
+            thread.start()
+            thread.join()
+
+            assert counts == [1]
+
+            lock.read_lock.release()
+            assert client.get_children(self.path) == []
+            assert not _shared_leases
+
+    def test_requires_holding_exactly_once(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, self.path, 1)
+
+            with self.assertRaises(ThreadError):
+                lock.downgrade()
+
+            with lock.read_lock:
+                with lock.read_lock:
+                    with self.assertRaises(ThreadError):
+                        lock.upgrade()
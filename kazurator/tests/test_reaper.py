@@ -0,0 +1,166 @@
+import logging
+from kazurator import Mutex, Reaper
+from kazurator.testing import FakeZooKeeper
+from time import time
+from unittest import TestCase
+from . import fake_client
+
+
+class TestReaper(TestCase):
+    def setUp(self):
+        self.root = "/haderp"
+        self.server = FakeZooKeeper()
+
+    def _used(self, client, path):
+        # a lock directory that has been locked in and released
+        with Mutex(client, path):
+            pass
+
+    def test_deletes_empty_lock_directories(self):
+        with fake_client(self.server) as client:
+            self._used(client, "/haderp/a")
+            self._used(client, "/haderp/b/c")
+            client.ensure_path("/haderp/fresh")
+
+            assert Reaper(client, self.root, rate=0).run_once() == 3
+
+            # the root and never used directories are left alone
+            assert client.get_children(self.root) == ["fresh"]
+
+    def test_keeps_held_locks(self):
+        with fake_client(self.server) as client:
+            self._used(client, "/haderp/a")
+
+            with Mutex(client, "/haderp/a"):
+                reaper = Reaper(client, self.root, rate=0)
+                assert reaper.run_once() == 0
+                assert len(client.get_children("/haderp/a")) == 1
+
+    def test_deletes_persistent_protected_nodes(self):
+        with fake_client(self.server) as client:
+            client.create("/haderp/a/_c_abc-lock-0000000000", makepath=True)
+            client.create(
+                "/haderp/b/_c_def-lock-0000000000",
+                ephemeral=True,
+                makepath=True
+            )
+
+            assert Reaper(client, self.root, rate=0).run_once() == 2
+            assert client.get_children(self.root) == ["b"]
+
+    def test_resumes_where_the_last_batch_stopped(self):
+        with fake_client(self.server) as client:
+            for name in "abcde":
+                self._used(client, "/haderp/" + name)
+
+            reaper = Reaper(client, self.root, batch_size=2, rate=0)
+            assert reaper.run_once() == 2
+            assert reaper.cursor == ("b",)
+            assert client.get_children(self.root) == ["c", "d", "e"]
+
+            assert reaper.run_once() == 2
+            assert reaper.run_once() == 1
+            assert reaper.cursor is None
+            assert client.get_children(self.root) == []
+
+    def test_reapers_share_their_position(self):
+        with fake_client(self.server) as client:
+            for name in "abcd":
+                self._used(client, "/haderp/" + name)
+
+            state = "/reapers/haderp"
+            first = Reaper(client, self.root, batch_size=2, rate=0,
+                           state_path=state)
+            second = Reaper(client, self.root, batch_size=2, rate=0,
+                            state_path=state)
+
+            assert first.run_once() == 2
+            assert client.get(state)[0] == b"b"
+
+            assert second.run_once() == 2
+            assert client.get_children(self.root) == []
+
+            # that was the end of the walk, so the next one starts over
+            assert client.get(state)[0] == b""
+
+    def test_position_survives_on_servers_without_containers(self):
+        server = FakeZooKeeper(containers=False)
+
+        with fake_client(server) as client:
+            for name in "abcd":
+                client.create("/haderp/_c_" + name + "-lock-0000000000",
+                              makepath=True)
+
+            state = "/reapers/haderp"
+            first = Reaper(client, self.root, batch_size=2, rate=0,
+                           state_path=state)
+            second = Reaper(client, self.root, batch_size=2, rate=0,
+                            state_path=state)
+
+            # releasing the mutex cleans up its directory, not our position
+            assert first.run_once() == 2
+            assert client.get(state)[0] == b"_c_b-lock-0000000000"
+
+            assert second.run_once() == 2
+            assert client.get_children(self.root) == []
+
+    def test_state_path_inside_root_is_skipped(self):
+        with fake_client(self.server) as client:
+            self._used(client, "/haderp/a")
+
+            reaper = Reaper(client, self.root, rate=0,
+                            state_path="/haderp/reaper")
+            assert reaper.run_once() == 1
+            assert client.get_children(self.root) == ["reaper"]
+
+    def test_background_failures_are_logged(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger("kazurator.reaper")
+        logger.addHandler(handler)
+
+        try:
+            with fake_client(self.server) as client:
+                reaper = Reaper(client, self.root, interval=0.01, rate=0)
+                client.inject_failure("exists")
+                reaper.start()
+
+                try:
+                    deadline = time() + 1
+                    while not records and time() < deadline:
+                        reaper._stopped.wait(0.01)
+                finally:
+                    reaper.stop()
+        finally:
+            logger.removeHandler(handler)
+
+        assert records[0].getMessage() == "Failed to reap /haderp"
+        assert records[0].exc_info
+
+    def test_calls_are_rate_limited(self):
+        with fake_client(self.server) as client:
+            for name in "abc":
+                self._used(client, "/haderp/" + name)
+
+            # exists and get_children on the root, then exists and delete
+            # for each directory
+            start = time()
+            assert Reaper(client, self.root, rate=40).run_once() == 3
+            assert time() - start >= 7 / 40.0
+
+    def test_runs_in_the_background(self):
+        with fake_client(self.server) as client:
+            self._used(client, "/haderp/a")
+
+            reaper = Reaper(client, self.root, interval=0.01, rate=0)
+            reaper.start()
+
+            try:
+                deadline = time() + 1
+                while client.get_children(self.root) and time() < deadline:
+                    reaper._stopped.wait(0.01)
+            finally:
+                reaper.stop()
+
+            assert client.get_children(self.root) == []
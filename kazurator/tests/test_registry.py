@@ -0,0 +1,83 @@
+import gc
+from kazurator import LockRegistry, Mutex, ReadWriteLock
+from kazurator.registry import registry
+from kazurator.testing import FakeZooKeeper
+from unittest import TestCase
+from . import fake_client
+
+
+class TestLockRegistry(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+
+    def test_instances_are_shared(self):
+        with fake_client(self.server) as client:
+            locks = LockRegistry()
+            mutex = locks.mutex(client, "/haderp/a", timeout=0.5)
+
+            assert isinstance(mutex, Mutex)
+            assert mutex.timeout == 0.5
+            assert locks.mutex(client, "/haderp/a") is mutex
+            assert locks.read_write_lock(client, "/haderp/a") is not mutex
+            assert locks.mutex(client, "/haderp/b") is not mutex
+
+            assert (locks.hits, locks.misses) == (1, 3)
+
+    def test_reentrant_across_lookups(self):
+        with fake_client(self.server) as client:
+            locks = LockRegistry()
+
+            with locks.read_write_lock(client, "/haderp/a").write_lock:
+                with locks.read_write_lock(client, "/haderp/a").write_lock:
+                    assert len(client.get_children("/haderp/a")) == 1
+
+    def test_evicts_least_recently_used(self):
+        with fake_client(self.server) as client:
+            locks = LockRegistry(max_size=2)
+            locks.mutex(client, "/haderp/a")
+            locks.mutex(client, "/haderp/b")
+            locks.mutex(client, "/haderp/a")
+            locks.mutex(client, "/haderp/c")
+
+            assert len(locks) == 2
+            assert locks.evictions == 1
+
+            gc.collect()
+            locks.mutex(client, "/haderp/b")
+            assert locks.misses == 4
+
+    def test_held_locks_are_not_evicted(self):
+        with fake_client(self.server) as client:
+            locks = LockRegistry(max_size=1)
+
+            held = locks.mutex(client, "/haderp/a")
+
+            with held:
+                locks.mutex(client, "/haderp/b")
+                assert len(locks) == 2
+                assert locks.evictions == 0
+                assert locks.mutex(client, "/haderp/a") is held
+
+            locks.mutex(client, "/haderp/b")
+            assert len(locks) == 1
+
+    def test_evicted_instances_still_in_use_are_reused(self):
+        with fake_client(self.server) as client:
+            locks = LockRegistry(max_size=1)
+            lock = locks.read_write_lock(client, "/haderp/a")
+            locks.read_write_lock(client, "/haderp/b")
+
+            assert locks.evictions == 1
+            assert locks.read_write_lock(client, "/haderp/a") is lock
+
+    def test_read_write_lock_is_acquired(self):
+        with fake_client(self.server) as client:
+            lock = ReadWriteLock(client, "/haderp/a")
+            assert not lock.is_acquired
+            assert "read_lock" not in lock.__dict__
+
+            with lock.read_lock:
+                assert lock.is_acquired
+
+    def test_process_wide_registry(self):
+        assert isinstance(registry, LockRegistry)
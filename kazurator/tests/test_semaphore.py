@@ -0,0 +1,112 @@
+import struct
+from kazoo.exceptions import LockTimeout
+from kazurator import Mutex, Semaphore
+from kazurator.testing import FakeZooKeeper
+from threading import Event, Thread, Timer
+from time import sleep
+from unittest import TestCase
+from . import fake_client
+
+
+class TestSemaphore(TestCase):
+    def setUp(self):
+        self.count_path = "/haderp/some_count"
+        self.path = "/haderp/some_semaphore"
+        self.server = FakeZooKeeper()
+
+    def test_leases_up_to_max_leases(self):
+        with fake_client(self.server) as client:
+            semaphore = Semaphore(client, self.path, 2, timeout=0.2)
+            first = semaphore.acquire()
+            second = semaphore.acquire()
+
+            assert len(semaphore.get_participant_nodes()) == 2
+            with self.assertRaises(LockTimeout):
+                semaphore.acquire()
+
+            # the timed out lease isn't left behind
+            assert len(semaphore.get_participant_nodes()) == 2
+
+            first.release()
+            with semaphore.acquire():
+                assert len(semaphore.get_participant_nodes()) == 2
+
+            second.release()
+            assert semaphore.get_participant_nodes() == []
+
+    def test_acquire_raises_when_the_connection_drops(self):
+        with fake_client(self.server) as client:
+            with fake_client(self.server) as other:
+                semaphore = Semaphore(client, self.path, timeout=1)
+
+                # so the acquire is waiting when the connection drops
+                with Mutex(other, self.path + "/locks"):
+                    Timer(0.1, client.suspend).start()
+
+                    with self.assertRaises(LockTimeout):
+                        semaphore.acquire()
+
+                client.resume()
+                assert semaphore.get_participant_nodes() == []
+
+    def test_uses_curators_layout(self):
+        with fake_client(self.server) as client:
+            with Semaphore(client, self.path).acquire() as lease:
+                assert lease.path.startswith(self.path + "/leases/_c_")
+                assert lease.path[:-10].endswith("-lease-")
+
+            assert client.exists(self.path + "/locks")
+
+    def test_shared_count_is_seeded_and_read(self):
+        with fake_client(self.server) as client:
+            semaphore = Semaphore(client, self.path, 3, self.count_path)
+            assert semaphore.max_leases == 3
+
+            data, _ = client.get(self.count_path)
+            assert struct.unpack(">i", data)[0] == 3
+
+            # other processes pick up the stored value, not their own seed
+            with fake_client(self.server) as other:
+                assert Semaphore(other, self.path, 1, self.count_path) \
+                    .max_leases == 3
+
+    def test_raising_the_count_lets_waiters_in(self):
+        with fake_client(self.server) as client:
+            with fake_client(self.server) as other:
+                holder = Semaphore(client, self.path, 1, self.count_path)
+                lease = holder.acquire()
+
+                waiter = Semaphore(other, self.path, 1, self.count_path, 5)
+                leased = Event()
+                thread = Thread(target=lambda: (
+                    waiter.acquire() and leased.set()
+                ))
+                thread.start()
+
+                while len(holder.get_participant_nodes()) < 2:
+                    sleep(0.01)
+
+                assert not leased.is_set()
+
+                holder.max_leases = 2
+                assert leased.wait(1)
+                assert holder.max_leases == 2
+
+                thread.join()
+                lease.release()
+
+    def test_only_listens_while_leases_are_held(self):
+        with fake_client(self.server) as client:
+            semaphore = Semaphore(client, self.path, 2, self.count_path)
+            assert semaphore._listener not in client.state_listeners
+
+            first = semaphore.acquire()
+            second = semaphore.acquire()
+            assert semaphore._listener in client.state_listeners
+
+            first.release()
+            first.release()  # releasing twice doesn't count twice
+            assert semaphore._listener in client.state_listeners
+
+            second.release()
+            assert semaphore._listener not in client.state_listeners
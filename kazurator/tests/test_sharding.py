@@ -0,0 +1,103 @@
+from kazurator import Mutex, ReadWriteLock, ShardedLocks
+from kazurator.instrumentation import LockObserver
+from kazurator.testing import FakeClient, FakeZooKeeper
+from unittest import TestCase
+
+
+class TestShardedLocks(TestCase):
+    def setUp(self):
+        self.clients = {}
+
+        for name in ("a", "b", "c"):
+            client = FakeClient(FakeZooKeeper())
+            client.start()
+            self.clients[name] = client
+
+    def tearDown(self):
+        for client in self.clients.values():
+            client.stop()
+
+    def _paths(self, count=1000):
+        return ["/jobs/%d" % i for i in range(count)]
+
+    def test_paths_map_to_one_shard_everywhere(self):
+        locks = ShardedLocks(self.clients)
+        other = ShardedLocks(dict(reversed(list(self.clients.items()))))
+
+        for path in self._paths(100):
+            assert locks.shard_for(path) == other.shard_for(path)
+            assert locks.client_for(path) is \
+                self.clients[locks.shard_for(path)]
+
+    def test_paths_are_spread_over_shards(self):
+        locks = ShardedLocks(self.clients)
+        counts = dict((name, 0) for name in self.clients)
+
+        for path in self._paths():
+            counts[locks.shard_for(path)] += 1
+
+        for count in counts.values():
+            assert 200 < count < 470
+
+    def test_adding_a_shard_moves_few_paths(self):
+        before = ShardedLocks(dict(list(self.clients.items())[:2]))
+        after = ShardedLocks(self.clients)
+
+        moved = [
+            path for path in self._paths()
+            if before.shard_for(path) != after.shard_for(path)
+        ]
+
+        # only paths going to the new shard move
+        assert len(moved) < 470
+        assert all(after.shard_for(path) == "c" for path in moved)
+
+    def test_locks_are_created_on_their_shard(self):
+        locks = ShardedLocks(self.clients)
+        path = "/jobs/1"
+        client = locks.client_for(path)
+
+        mutex = locks.mutex(path, timeout=0.5)
+        assert isinstance(mutex, Mutex)
+
+        with mutex:
+            assert len(client.get_children(path)) == 1
+
+        lock = locks.read_write_lock(path)
+        assert isinstance(lock, ReadWriteLock)
+
+        with lock.read_lock:
+            assert len(client.get_children(path)) == 1
+
+    def test_reports_load_per_shard(self):
+        events = []
+
+        class Observer(LockObserver):
+            def acquire_finished(self, path, seconds, acquired):
+                events.append(path)
+
+        locks = ShardedLocks(self.clients)
+        path = "/jobs/1"
+        shard = locks.shard_for(path)
+
+        for _ in range(3):
+            with locks.mutex(path, observer=Observer()):
+                pass
+
+        load = locks.load()
+        assert sorted(load) == ["a", "b", "c"]
+        assert load[shard].locks == 3
+        assert load[shard].acquires == 3
+        assert load[shard].calls > 0
+        assert len(events) == 3
+
+        for name in load:
+            if name != shard:
+                assert load[name] == (0, 0, 0)
+
+    def test_clients_can_be_listed(self):
+        locks = ShardedLocks(list(self.clients.values()))
+        assert locks.shards == ["0", "1", "2"]
+
+        with self.assertRaises(ValueError):
+            ShardedLocks([])
@@ -0,0 +1,178 @@
+import time
+from kazoo.exceptions import (
+    ConnectionLoss,
+    NodeExistsError,
+    NoNodeError,
+    RolledBackError,
+    RuntimeInconsistency
+)
+from kazoo.protocol.states import EventType, KazooState
+from kazurator import Mutex
+from kazurator.testing import FakeClient, FakeZooKeeper
+from threading import Event, Thread
+from unittest import TestCase
+from . import fake_client
+
+
+class TestFakeClient(TestCase):
+    def setUp(self):
+        self.server = FakeZooKeeper()
+        self.path = "/haderp/some_path"
+
+    def test_create_sequential_nodes(self):
+        with fake_client(self.server) as client:
+            first = client.create(self.path + "/lock-", sequence=True,
+                                  makepath=True)
+            second = client.create(self.path + "/lock-", sequence=True)
+
+            assert first == self.path + "/lock-0000000000"
+            assert second == self.path + "/lock-0000000001"
+            assert sorted(client.get_children(self.path)) == [
+                "lock-0000000000",
+                "lock-0000000001"
+            ]
+
+    def test_create_raises_when_parent_missing(self):
+        with fake_client(self.server) as client:
+            with self.assertRaises(NoNodeError):
+                client.create(self.path + "/lock-")
+
+    def test_sequence_wraps_like_a_signed_int(self):
+        with fake_client(self.server) as client:
+            client.ensure_path(self.path)
+            self.server.set_sequence(self.path, 2 ** 31 - 1)
+
+            first = client.create(self.path + "/lock-", sequence=True)
+            second = client.create(self.path + "/lock-", sequence=True)
+
+            assert first.endswith("lock-2147483647")
+            assert second.endswith("lock--2147483648")
+
+    def test_ephemeral_nodes_are_removed_with_the_session(self):
+        with fake_client(self.server) as client:
+            client.create(self.path + "/lock-", ephemeral=True,
+                          sequence=True, makepath=True)
+
+        with fake_client(self.server) as client:
+            assert client.get_children(self.path) == []
+
+    def test_exists_watch_fires_on_delete(self):
+        events = []
+        fired = Event()
+
+        def watch(event):
+            events.append(event)
+            fired.set()
+
+        with fake_client(self.server) as client:
+            path = client.create(self.path, makepath=True)
+            assert client.exists(path, watch)
+
+            client.delete(path)
+            assert fired.wait(1)
+            assert events[0].type == EventType.DELETED
+            assert events[0].path == path
+
+    def test_expire_session_drops_ephemerals_and_notifies(self):
+        states = []
+
+        with fake_client(self.server) as client:
+            client.add_listener(states.append)
+            path = client.create(self.path, ephemeral=True, makepath=True)
+            session_id = client.session_id
+
+            client.expire_session()
+
+            assert not client.exists(path)
+            assert client.session_id != session_id
+            assert states == [KazooState.LOST, KazooState.CONNECTED]
+
+    def test_suspended_client_raises_connection_loss(self):
+        with fake_client(self.server) as client:
+            client.suspend()
+
+            with self.assertRaises(ConnectionLoss):
+                client.exists(self.path)
+
+            client.resume()
+            assert client.exists(self.path) is None
+
+    def test_injected_failure_can_be_applied_on_the_server(self):
+        with fake_client(self.server) as client:
+            client.ensure_path(self.path)
+            client.inject_failure("create", applied=True)
+
+            with self.assertRaises(ConnectionLoss):
+                client.create(self.path + "/lock-", sequence=True)
+
+            assert len(client.get_children(self.path)) == 1
+
+    def test_transactions_are_atomic(self):
+        with fake_client(self.server) as client:
+            client.ensure_path(self.path)
+            client.create(self.path + "/taken")
+
+            transaction = client.transaction()
+            transaction.create(self.path + "/lock-", sequence=True)
+            transaction.create(self.path + "/taken")
+            transaction.delete(self.path + "/taken")
+            results = transaction.commit()
+
+            assert isinstance(results[0], RolledBackError)
+            assert isinstance(results[1], NodeExistsError)
+            assert isinstance(results[2], RuntimeInconsistency)
+            assert client.get_children(self.path) == ["taken"]
+
+            transaction = client.transaction()
+            transaction.create(self.path + "/lock-", sequence=True)
+            transaction.delete(self.path + "/taken")
+
+            assert transaction.commit() == [self.path + "/lock-0000000001",
+                                            True]
+            assert client.get_children(self.path) == ["lock-0000000001"]
+
+    def test_latency_is_applied_per_round_trip(self):
+        with fake_client(self.server, latency=0.05) as client:
+            start = time.time()
+            client.exists(self.path)
+
+            assert time.time() - start >= 0.05
+
+    def test_async_operations(self):
+        with fake_client(self.server, latency=0.01) as client:
+            result = client.create_async(self.path, makepath=True)
+            assert result.get(timeout=1) == self.path
+            assert client.exists_async(self.path).get(timeout=1)
+
+    def test_mutex_contention_across_sessions(self):
+        clients = [FakeClient(self.server) for _ in range(20)]
+        holders = []
+        overlaps = []
+
+        def contend(client):
+            mutex = Mutex(client, self.path, timeout=5)
+
+            with mutex:
+                if holders:
+                    overlaps.append(client)
+
+                holders.append(client)
+                time.sleep(0.001)
+                holders.remove(client)
+
+        try:
+            for client in clients:
+                client.start()
+
+            threads = [Thread(target=contend, args=(c,)) for c in clients]
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            assert overlaps == []
+            assert clients[0].get_children(self.path) == []
+        finally:
+            for client in clients:
+                client.stop()
@@ -1,12 +1,26 @@
 from contextlib import contextmanager
 from kazoo.retry import ForceRetryError, RetryFailedError
 from os.path import join
+from threading import current_thread
 
 
 def make_path(*paths):
     return join("/", *paths)
 
 
+def owner_getter(handler):
+    # Returns a function identifying who holds a lock right now. kazoo's
+    # gevent and eventlet handlers run every greenlet on one thread, so under
+    # those it's the current greenlet rather than the current thread.
+    name = getattr(handler, "name", "")
+
+    if "gevent" in name or "eventlet" in name:
+        from greenlet import getcurrent
+        return getcurrent
+
+    return current_thread
+
+
 class lazyproperty(object):
     def __init__(self, fn):
         self._fn = fn
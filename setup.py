@@ -45,7 +45,7 @@ setup(
         "Topic :: System :: Networking",
     ],
     keywords="zookeeper lock",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     install_requires=installation_requirements,
     tests_require=test_requirements,
     test_suite="kazurator.tests",